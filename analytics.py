@@ -24,7 +24,7 @@ class Analytics:
         # Извлекаем данные
         dates = []
         moods = []
-        for o in obs[-30:]:  # Последние 30 наблюдений
+        for o in list(obs)[-30:]:  # Последние 30 наблюдений
             try:
                 ts = datetime.fromisoformat(o["ts"])
                 dates.append(ts)
@@ -145,7 +145,7 @@ class Analytics:
         # Матрица: день недели x час
         heatmap = np.zeros((7, 24))
         
-        for o in obs[-100:]:  # Последние 100 наблюдений
+        for o in list(obs)[-100:]:  # Последние 100 наблюдений
             try:
                 ts = datetime.fromisoformat(o["ts"])
                 day = ts.weekday()  # 0=Monday
@@ -72,7 +72,7 @@ class ProactiveAgent:
             # Обновляем время последней отправки
             lt[last_key] = datetime.now().isoformat()
             from state import save_long_term
-            save_long_term()
+            save_long_term(self.user_id)
             return True
         
         return False
@@ -184,7 +184,7 @@ class ProactiveAgent:
             await self.bot.send_message(chat_id=self.user_id, text=message)
             lt["last_support_message"] = datetime.now().isoformat()
             from state import save_long_term
-            save_long_term()
+            save_long_term(self.user_id)
         except Exception as e:
             logger.error("Failed to send support message to %s: %s", self.user_id, e)
     
@@ -223,7 +223,7 @@ class ProactiveAgent:
             await self.bot.send_message(chat_id=self.user_id, text=message)
             lt[f"last_reminder_{goal.id}"] = datetime.now().isoformat()
             from state import save_long_term
-            save_long_term()
+            save_long_term(self.user_id)
         except Exception as e:
             logger.error("Failed to send overdue reminder to %s: %s", self.user_id, e)
 
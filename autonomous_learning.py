@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 from datetime import datetime
 import asyncio
@@ -7,6 +8,13 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _write_json(path: Path, data) -> None:
+    """Compact JSON via a temp file + os.replace: a crash mid-write never leaves a corrupt file"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
 class LearningEngine:
     def __init__(self):
         self.skills_db = Path("skills_database.json")
@@ -19,10 +27,7 @@ class LearningEngine:
         return {}
     
     def _save_skills(self):
-        self.skills_db.write_text(
-            json.dumps(self.skills, ensure_ascii=False, indent=2),
-            encoding="utf-8"
-        )
+        _write_json(self.skills_db, self.skills)
     
     def has_skill(self, skill_name: str) -> bool:
         """Проверить наличие навыка"""
@@ -50,10 +55,7 @@ class LearningEngine:
             logs = json.loads(self.learning_log.read_text(encoding="utf-8"))
         
         logs.append(log_entry)
-        self.learning_log.write_text(
-            json.dumps(logs, ensure_ascii=False, indent=2),
-            encoding="utf-8"
-        )
+        _write_json(self.learning_log, logs)
         
         logger.info(f"New skill learned: {skill_name}")
     
@@ -35,6 +35,7 @@ ADMIN_USER_IDS = {
 # --- Defaults and limits ---
 DEFAULT_MODEL = "gemini-2.5-flash-lite"
 MESSAGE_CHUNK_SIZE = 4000
+STREAM_EDIT_INTERVAL = 1.0  # секунды между правками сообщения при стриминге ответа (лимит Telegram ~1 в секунду на чат)
 
 # --- External data sources ---
 FB_DB_PATH = Path(os.getenv("FB_DB_PATH", "messages.db"))
@@ -1,17 +1,21 @@
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List, Optional
 import asyncio
 import logging
 import random
 import os
+import time
 from datetime import datetime
 
-import requests
-from telegram import Update
+import httpx
+import orjson
+from telegram import Message, Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
 from config import (
     GEMINI_API_KEY,
     MESSAGE_CHUNK_SIZE,
+    STREAM_EDIT_INTERVAL,
     SYSTEM_PROMPT,
     SAFETY_SETTINGS,
     GENERATION_CONFIG,
@@ -21,7 +25,7 @@ from state import (
     get_current_model,
     reset_history,
     set_model,
-    get_history,
+    get_history_tail,
     add_observation,
     record_reply,
     get_profile_summary,
@@ -62,8 +66,7 @@ logger = logging.getLogger(__name__)
 
 def build_conversation_history(user_id: int, max_messages: int = 12) -> List[dict]:
     """Build conversation history for Gemini: user/model pairs, skip system entries."""
-    history = get_history(user_id)
-    trimmed = history[-max_messages:]
+    trimmed = get_history_tail(user_id, max_messages)
     contents = []
     for item in trimmed:
         role = item.get("role")
@@ -75,13 +78,12 @@ def build_conversation_history(user_id: int, max_messages: int = 12) -> List[dic
 
 
 def adjust_reply_style(profile: dict, last_text: str) -> tuple:
-    """Adapt system prompt and generation config based on mood/progress and intent length."""
+    """Style instruction (added after SYSTEM_PROMPT) and generation config based on mood/progress and intent length."""
     mood = profile.get("mood_score", 0.0)
     progress = profile.get("progress_score", 0.0)
     active = get_active_scenarios(profile["user_id"])
     text_lower = (last_text or "").lower()
 
-    base_instruction = SYSTEM_PROMPT["content"]
     style_parts = []
     gen_cfg = GENERATION_CONFIG.copy()
     try:
@@ -129,20 +131,130 @@ def adjust_reply_style(profile: dict, last_text: str) -> tuple:
         "adjust_reply_style user=%s mood=%.2f progress=%.2f active=%s gen_cfg=%s",
         profile["user_id"], mood, progress, active, gen_cfg,
     )
-    return base_instruction + "\n" + extra_instruction, gen_cfg
-
-
-async def _post_gemini(payload: dict) -> requests.Response:
-    """Offload blocking HTTP to a thread executor."""
-    loop = asyncio.get_running_loop()
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{payload['model']}:generateContent?key={GEMINI_API_KEY}"
-    body = {
-        "contents": payload["contents"],
-        "systemInstruction": payload["systemInstruction"],
-        "safetySettings": payload["safetySettings"],
-        "generationConfig": payload["generationConfig"],
-    }
-    return await loop.run_in_executor(None, lambda: requests.post(url, json=body, timeout=60))
+    return extra_instruction, gen_cfg
+
+
+class GeminiAPIError(Exception):
+    """Non-200 answer from Gemini API."""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"Gemini API error {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Static parts of every Gemini request body, serialized once at import.
+_SYSTEM_PROMPT_PART_JSON = orjson.dumps({"text": SYSTEM_PROMPT["content"]})
+_SAFETY_SETTINGS_JSON = orjson.dumps(SAFETY_SETTINGS)
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Shared async HTTP client: keeps connections to Gemini alive between messages."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=60)
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _encode_body(payload: dict) -> bytes:
+    """Serialize request body, splicing in the pre-serialized system prompt and safety settings."""
+    return b"".join((
+        b'{"contents":', orjson.dumps(payload["contents"]),
+        b',"systemInstruction":{"parts":[', _SYSTEM_PROMPT_PART_JSON, b",",
+        orjson.dumps({"text": payload["styleInstruction"]}), b"]}",
+        b',"safetySettings":', _SAFETY_SETTINGS_JSON,
+        b',"generationConfig":', orjson.dumps(payload["generationConfig"]),
+        b"}",
+    ))
+
+
+async def _stream_gemini(payload: dict) -> AsyncIterator[str]:
+    """Yield answer text pieces from Gemini SSE stream as soon as they arrive."""
+    url = (
+        f"https://generativelanguage.googleapis.com/v1beta/models/{payload['model']}"
+        f":streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    )
+    async with _get_http_client().stream(
+        "POST", url, content=_encode_body(payload), headers={"Content-Type": "application/json"}
+    ) as response:
+        if response.status_code != 200:
+            error_body = await response.aread()
+            raise GeminiAPIError(response.status_code, error_body.decode("utf-8", "replace"))
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = orjson.loads(line[5:])
+            for candidate in chunk.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+
+
+async def _show_text(update: Update, message: Optional[Message], shown: str, text: str) -> tuple:
+    """Send a new message or edit the current one; skip no-op edits.
+
+    Telegram trims surrounding whitespace, so texts are compared stripped and blank text is not sent.
+    RetryAfter (flood control) is left to the caller.
+    """
+    text = text.strip()
+    if not text or text == shown:
+        return message, shown
+    try:
+        if message is None:
+            message = await update.message.reply_text(text)
+        else:
+            await message.edit_text(text)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return message, text
+
+
+async def _show_final(update: Update, message: Optional[Message], shown: str, text: str) -> None:
+    """Last update of a message: wait out flood control instead of losing the text."""
+    while True:
+        try:
+            await _show_text(update, message, shown, text)
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def reply_streaming(update: Update, pieces: AsyncIterator[str]) -> str:
+    """Show the answer while it is generated; return the full text.
+
+    The current message is edited at most every STREAM_EDIT_INTERVAL seconds,
+    after MESSAGE_CHUNK_SIZE chars the next part goes into a new message.
+    Intermediate edits are best effort: under flood control they pause, the final update shows everything.
+    """
+    answer = ""
+    offset = 0  # start of the part shown in the current message
+    message, shown = None, ""
+    next_edit = 0.0
+    async for piece in pieces:
+        answer += piece
+        while len(answer) - offset > MESSAGE_CHUNK_SIZE:
+            await _show_final(update, message, shown, answer[offset : offset + MESSAGE_CHUNK_SIZE])
+            offset += MESSAGE_CHUNK_SIZE
+            message, shown = None, ""
+        now = time.monotonic()
+        if now >= next_edit:
+            try:
+                message, shown = await _show_text(update, message, shown, answer[offset:])
+                next_edit = now + STREAM_EDIT_INTERVAL
+            except RetryAfter as e:
+                next_edit = now + e.retry_after
+    await _show_final(update, message, shown, answer[offset:])
+    return answer
 
 
 def build_coach_context(user_id: int) -> str:
@@ -445,10 +557,10 @@ async def goaldeep(update: Update, context: ContextTypes.DEFAULT_TYPE):
     from state import long_term
     lt = long_term[str(user_id)]
     text = (
-        f"Скрытые цели: {lt.get('implicit_goals', [])}\n"
-        f"Избегаемые цели: {lt.get('avoided_goals', [])}\n"
-        f"Прогноз целей: {lt.get('predicted_goals', [])}\n"
-        f"Застрявшие цели: {lt.get('stalled_goals', [])}"
+        f"Скрытые цели: {list(lt.get('implicit_goals', ()))}\n"
+        f"Избегаемые цели: {list(lt.get('avoided_goals', ()))}\n"
+        f"Прогноз целей: {list(lt.get('predicted_goals', ()))}\n"
+        f"Застрявшие цели: {list(lt.get('stalled_goals', ()))}"
     )
     await update.message.reply_text(text)
 
@@ -503,7 +615,7 @@ def build_payload(user_id: int, text: str) -> dict:
     super_context = build_super_context(user_id)
     conversation = build_conversation_history(user_id)
     profile = get_profile(user_id)
-    system_instruction, gen_cfg = adjust_reply_style(profile, text)
+    style_instruction, gen_cfg = adjust_reply_style(profile, text)
 
     contents = [
         {
@@ -518,8 +630,7 @@ def build_payload(user_id: int, text: str) -> dict:
     return {
         "model": get_current_model(),
         "contents": contents,
-        "systemInstruction": {"parts": [{"text": system_instruction}]},
-        "safetySettings": SAFETY_SETTINGS,
+        "styleInstruction": style_instruction,
         "generationConfig": gen_cfg,
     }
 
@@ -566,23 +677,19 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE, te
     payload = build_payload(user_id, text)
 
     try:
-        response = await _post_gemini(payload)
-        if response.status_code == 200:
-            answer = response.json()["candidates"][0]["content"]["parts"][0]["text"]
+        answer = await reply_streaming(update, _stream_gemini(payload))
+        if answer:
             append_message(user_id, "model", answer)
             record_reply(user_id, answer)
             # metacognition + tuning after reply
             evaluate_metacognition(user_id, text, answer)
             adjust_from_metacognition(user_id)
             self_tuning(user_id)
-
-            # Split long answers
-            for i in range(0, len(answer), MESSAGE_CHUNK_SIZE):
-                await update.message.reply_text(answer[i : i + MESSAGE_CHUNK_SIZE])
         else:
-            await update.message.reply_text(f"Gemini API error: {response.status_code}")
-            logger.error("Gemini API error %s for user %s: %s", response.status_code, user_id, response.text)
-
+            await update.message.reply_text("Не удалось ответить: пустой ответ модели.")
+    except GeminiAPIError as e:
+        await update.message.reply_text(f"Gemini API error: {e.status_code}")
+        logger.error("Gemini API error %s for user %s: %s", e.status_code, user_id, e.body)
     except Exception as e:
         logger.exception("Error handling message for user %s: %s", user_id, e)
         await update.message.reply_text(f"Не удалось ответить: {str(e)}")
@@ -1,14 +1,20 @@
 import logging
 import os
+import queue
 import sys
 import atexit
-import asyncio
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
-import psutil
 from telegram import Update
 from telegram.ext import (
     Application,
-    CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
@@ -84,7 +90,7 @@ from handlers import (
     mark_bad_reply,
     feedback_log,
 )
-from state import load_memory, get_current_model
+from state import get_current_model
 
 
 LOG_FILE = "bot.log"
@@ -99,59 +105,165 @@ class SafeJobQueue(JobQueue):
         self._application = application
 
 
+COMMANDS = [
+    # ============ Базовые команды ============
+    ("start", start),
+    ("help", help_command),
+    ("clear", clear),
+    ("model", switch_model),
+    ("memory", show_memory),
+    ("progress", progress),
+    ("tips", tips),
+    ("filter", add_filter),
+    ("scenarios", scenarios),
+    ("goals", goals),
+    ("habits", habits),
+    ("month", month),
+    ("forecast", forecast),
+    # ============ Facebook messages ============
+    ("fbthreads", fbthreads),
+    ("fbthread", fbthread),
+    ("fbsearch", fbsearch),
+    # ============ Планы ============
+    ("plan", plan),
+    ("done", done),
+    # ============ Самоанализ ============
+    ("selfcheck", selfcheck),
+    ("selfanalyze", self_analyze),
+    ("websearch", web_search_cmd),
+    ("commands", list_commands),
+    ("runpython", run_python),
+    ("tuning", tuning),
+    ("reboot", reboot),
+    ("restart", restart),
+    # ============ Стратегия ============
+    ("strategy", strategy),
+    ("mindset", mindset),
+    ("personality", personality),
+    ("goaldeep", goaldeep),
+    # ============ Админ команды ============
+    ("status", status),
+    ("die", die),
+    # ============ НОВЫЕ: Самообучение ============
+    ("learnstats", learning_stats),
+    ("learn", trigger_learning),
+    ("insights", show_insights),
+    ("knowledge", knowledge_base),
+    ("readcode", read_code),
+    ("analyzecode", analyze_code),
+    # ============ НОВЫЕ: Продвинутая память ============
+    ("search", search_memory),
+    ("episodes", show_episodes),
+    ("episode", create_episode),
+    # ============ НОВЫЕ: Система целей ============
+    ("addgoal", add_goal),
+    ("listgoals", list_goals),
+    ("checkin", check_in_goal),
+    ("milestone", add_milestone),
+    ("complete", complete_milestone),
+    ("goalstats", goal_stats),
+    ("achievements", show_achievements),
+    # ============ НОВЫЕ: Проактивность ============
+    ("proactive", toggle_proactive),
+    ("schedule", set_schedule),
+    ("morningcheck", manual_checkin),
+    # ============ НОВЫЕ: Аналитика ============
+    ("moodchart", mood_chart),
+    ("goalschart", goals_chart),
+    ("activitychart", activity_chart),
+    ("weeklyreport", weekly_report),
+    # ============ Качество и фидбек ============
+    ("offlineeval", offline_eval_cmd),
+    ("evalreport", offline_eval_report),
+    ("bad", mark_bad_reply),
+    ("feedbacklog", feedback_log),
+]
+_COMMAND_TABLE = dict(COMMANDS)
+
+
+async def command_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """One handler for all commands: dict lookup instead of ~60 CommandHandler checks per update."""
+    message = update.effective_message
+    text = message.text or ""
+    parts = text.split()
+    name, _, target = parts[0][1:].partition("@")
+    if target and target.lower() != context.bot.username.lower():
+        return  # команда адресована другому боту в группе
+    callback = _COMMAND_TABLE.get(name.lower())
+    if callback is None:
+        return
+    context.args = parts[1:]  # как у CommandHandler
+    await callback(update, context)
+
+
+_log_listener: Optional[QueueListener] = None
+
+
 def configure_logging() -> None:
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-        handlers=[
-            logging.FileHandler(LOG_FILE, encoding="utf-8"),
-            logging.StreamHandler(sys.stdout),
-        ],
-    )
+    """Log via a queue: file/console writes run in a listener thread, not in the event loop."""
+    global _log_listener
+    formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    _log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+    # registered before main() adds its atexit hooks, so it runs last and flushes their logs too
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+_lock_fd = None
 
 
 def acquire_single_instance_lock() -> None:
-    """Ensure only one bot instance runs; terminate stale PID if needed."""
-    if os.path.exists(LOCK_FILE):
-        try:
-            with open(LOCK_FILE, "r", encoding="utf-8") as f:
-                pid_str = f.read().strip()
-            if pid_str.isdigit():
-                pid = int(pid_str)
-                if psutil.pid_exists(pid):
-                    try:
-                        p = psutil.Process(pid)
-                        p.terminate()
-                        p.wait(timeout=3)
-                        logging.getLogger(__name__).warning("Terminated previous bot instance pid=%s", pid)
-                    except Exception:
-                        pass
-        except Exception:
-            pass
-        try:
-            os.remove(LOCK_FILE)
-        except Exception:
-            pass
+    """Ensure only one bot instance runs: hold an OS lock on LOCK_FILE for process lifetime.
+
+    The OS drops the lock when the process exits or crashes, so stale lock files need no cleanup.
+    """
+    global _lock_fd
+    _lock_fd = open(LOCK_FILE, "a+", encoding="utf-8")
     try:
-        with open(LOCK_FILE, "w", encoding="utf-8") as f:
-            f.write(str(os.getpid()))
-    except Exception as e:
-        logging.getLogger(__name__).error("Cannot write lock file: %s", e)
+        if fcntl is not None:
+            fcntl.flock(_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            _lock_fd.seek(0)
+            msvcrt.locking(_lock_fd.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        _lock_fd.close()
+        _lock_fd = None
+        sys.exit(f"Another bot instance is already running ({LOCK_FILE} is locked).")
+    _lock_fd.seek(0)
+    _lock_fd.truncate()
+    _lock_fd.write(str(os.getpid()))
+    _lock_fd.flush()
 
 
 def save_on_exit() -> None:
-    from state import user_memory, long_term, _save_json, MEMORY_FILE, LONG_TERM_FILE
+    from state import force_flush
 
-    _save_json(MEMORY_FILE, user_memory)
-    _save_json(LONG_TERM_FILE, long_term)
+    force_flush()
 
 
 def release_lock() -> None:
+    global _lock_fd
+    if _lock_fd is None:
+        return
     try:
-        if os.path.exists(LOCK_FILE):
-            os.remove(LOCK_FILE)
+        _lock_fd.close()
     except Exception:
         pass
+    _lock_fd = None
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -174,17 +286,17 @@ async def start_proactive_agents(application: Application) -> None:
     logger = logging.getLogger(__name__)
     logger.info("Starting proactive agents for active users...")
     
-    # Получаем всех пользователей из памяти
-    for user_id_str in user_memory.keys():
+    # start_agent только планирует задачу в текущем loop (без I/O), поэтому
+    # запускаем синхронно; лог по каждому пользователю пишет сам start_agent.
+    started = 0
+    for user_id_str in list(user_memory.keys()):
         try:
-            user_id = int(user_id_str)
-            # Запускаем агента для каждого пользователя
-            proactive_manager.start_agent(application.bot, user_id)
-            logger.info("Proactive agent started for user %s", user_id)
+            proactive_manager.start_agent(application.bot, int(user_id_str))
+            started += 1
         except Exception as e:
             logger.error("Failed to start proactive agent for user %s: %s", user_id_str, e)
-    
-    logger.info("Proactive agents initialization complete")
+
+    logger.info("Proactive agents initialization complete: %s started", started)
 
 
 async def post_init(application: Application) -> None:
@@ -199,7 +311,9 @@ async def post_init(application: Application) -> None:
 
 async def on_shutdown(application: Application):
     from state import proactive_manager
+    from handlers import close_http_client
     proactive_manager.stop_all_agents()
+    await close_http_client()
 
 def main() -> None:
     if not TELEGRAM_TOKEN:
@@ -209,8 +323,6 @@ def main() -> None:
     atexit.register(save_on_exit)
     atexit.register(release_lock)
 
-    load_memory()
-
     application = (
         Application.builder()
         .job_queue(SafeJobQueue())
@@ -224,91 +336,9 @@ def main() -> None:
     # admin ids set
     application.bot_data["admin_ids"] = set(ADMIN_USER_IDS)
 
-    # ============ Базовые команды ============
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("clear", clear))
-    application.add_handler(CommandHandler("model", switch_model))
-    application.add_handler(CommandHandler("memory", show_memory))
-    application.add_handler(CommandHandler("progress", progress))
-    application.add_handler(CommandHandler("tips", tips))
-    application.add_handler(CommandHandler("filter", add_filter))
-    application.add_handler(CommandHandler("scenarios", scenarios))
-    application.add_handler(CommandHandler("goals", goals))
-    application.add_handler(CommandHandler("habits", habits))
-    application.add_handler(CommandHandler("month", month))
-    application.add_handler(CommandHandler("forecast", forecast))
-    
-    # ============ Facebook messages ============
-    application.add_handler(CommandHandler("fbthreads", fbthreads))
-    application.add_handler(CommandHandler("fbthread", fbthread))
-    application.add_handler(CommandHandler("fbsearch", fbsearch))
-    
-    # ============ Планы ============
-    application.add_handler(CommandHandler("plan", plan))
-    application.add_handler(CommandHandler("done", done))
-    
-    # ============ Самоанализ ============
-    application.add_handler(CommandHandler("selfcheck", selfcheck))
-    application.add_handler(CommandHandler("selfanalyze", self_analyze))
-    application.add_handler(CommandHandler("websearch", web_search_cmd))
-    application.add_handler(CommandHandler("commands", list_commands))
-    application.add_handler(CommandHandler("runpython", run_python))
-    application.add_handler(CommandHandler("tuning", tuning))
-    application.add_handler(CommandHandler("reboot", reboot))
-    application.add_handler(CommandHandler("restart", restart))
-    
-    # ============ Стратегия ============
-    application.add_handler(CommandHandler("strategy", strategy))
-    application.add_handler(CommandHandler("mindset", mindset))
-    application.add_handler(CommandHandler("personality", personality))
-    application.add_handler(CommandHandler("goaldeep", goaldeep))
-    
-    # ============ Админ команды ============
-    application.add_handler(CommandHandler("status", status))
-    application.add_handler(CommandHandler("die", die))
-    
-    # ============ НОВЫЕ: Самообучение ============
-    application.add_handler(CommandHandler("learnstats", learning_stats))
-    application.add_handler(CommandHandler("learn", trigger_learning))
-    application.add_handler(CommandHandler("insights", show_insights))
-    application.add_handler(CommandHandler("knowledge", knowledge_base))
-    application.add_handler(CommandHandler("readcode", read_code))
-    application.add_handler(CommandHandler("analyzecode", analyze_code))
-    
-    # ============ НОВЫЕ: Продвинутая память ============
-    application.add_handler(CommandHandler("search", search_memory))
-    application.add_handler(CommandHandler("episodes", show_episodes))
-    application.add_handler(CommandHandler("episode", create_episode))
-    
-    # ============ НОВЫЕ: Система целей ============
-    application.add_handler(CommandHandler("addgoal", add_goal))
-    application.add_handler(CommandHandler("listgoals", list_goals))
-    application.add_handler(CommandHandler("checkin", check_in_goal))
-    application.add_handler(CommandHandler("milestone", add_milestone))
-    application.add_handler(CommandHandler("complete", complete_milestone))
-    application.add_handler(CommandHandler("goalstats", goal_stats))
-    application.add_handler(CommandHandler("achievements", show_achievements))
-    
-    # ============ НОВЫЕ: Проактивность ============
-    application.add_handler(CommandHandler("proactive", toggle_proactive))
-    application.add_handler(CommandHandler("schedule", set_schedule))
-    application.add_handler(CommandHandler("morningcheck", manual_checkin))
-    
-    # ============ НОВЫЕ: Аналитика ============
-    application.add_handler(CommandHandler("moodchart", mood_chart))
-    application.add_handler(CommandHandler("goalschart", goals_chart))
-    application.add_handler(CommandHandler("activitychart", activity_chart))
-    application.add_handler(CommandHandler("weeklyreport", weekly_report))
-
-    # ============ Качество и фидбек ============
-    application.add_handler(CommandHandler("offlineeval", offline_eval_cmd))
-    application.add_handler(CommandHandler("evalreport", offline_eval_report))
-    application.add_handler(CommandHandler("bad", mark_bad_reply))
-    application.add_handler(CommandHandler("feedbacklog", feedback_log))
-
-    # text handler
+    # text handler first: обычный текст не проходит через ветку команд
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_handler(MessageHandler(filters.COMMAND, command_router))
 
     # error handler
     application.add_error_handler(error_handler)
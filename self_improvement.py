@@ -1,62 +1,268 @@
 from pathlib import Path
-import json
-from datetime import datetime
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import IntEnum
+from types import MappingProxyType
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import orjson
+
+    def _dumps_line(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+    _loads = orjson.loads
+except ImportError:  # orjson не установлен — stdlib json
+    import json
+
+    def _dumps_line(obj) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+    _loads = json.loads
+
+
+def _ignorecase_bytes(text: str) -> bytes:
+    """Регулярка по UTF-8 байтам без учёта регистра (re.IGNORECASE для bytes знает только ASCII)"""
+    parts = []
+    for ch in text:
+        variants = dict.fromkeys((ch.lower(), ch.upper()))
+        parts.append(b"(?:" + b"|".join(re.escape(v.encode("utf-8")) for v in variants) + b")")
+    return b"".join(parts)
+
+
+# Все анти-паттерны в одном регулярном выражении: один проход по сырым байтам файла, без decode
+_ANTIPATTERN_RE = re.compile(
+    b"(?P<ne_mogu>" + _ignorecase_bytes("не могу") + b")|(?P<todo>TODO)"
+)
+
+# Дешёвый предфильтр: без хотя бы одного из этих литералов регулярка не может сработать
+_PREFILTER_LITERALS = (b"TODO", " м".encode("utf-8"), " М".encode("utf-8"))
+
+
+class IssueKind(IntEnum):
+    """Тип найденной проблемы; значения совпадают с номерами групп в _ANTIPATTERN_RE"""
+    NE_MOGU = 1
+    TODO = 2
+
+
+# тип -> (issue, severity)
+_ANTIPATTERNS = {
+    IssueKind.NE_MOGU: ("Найдена фраза 'не могу'", "high"),
+    IssueKind.TODO: ("Есть незавершенные TODO", "medium"),
+}
+
+# Файлы от этого размера отображаются через mmap, мелкие дешевле прочитать целиком
+_MMAP_MIN_SIZE = 64 * 1024
+
+
+@contextmanager
+def _open_content(path: str) -> Iterator[Union[bytes, mmap.mmap]]:
+    """Содержимое файла для сканирования: bytes для мелких файлов, mmap для крупных"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_MIN_SIZE:
+            yield f.read()
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+
+# Максимум буферов в одном writev (IOV_MAX на Linux)
+_IOV_MAX = 1024
+
+# тип -> предложение (read-only, собирается один раз)
+_PROPOSALS = MappingProxyType({
+    IssueKind.NE_MOGU: "Заменить на конструктивное предложение решения",
+    IssueKind.TODO: "Реализовать или убрать TODO"
+})
 
 
 class SelfImprover:
     def __init__(self):
-        self.improvements_log = Path("improvements_log.json")
+        self.improvements_log = Path("improvements_log.jsonl")  # JSON Lines: запись = дозапись одной строки
         self.code_backups = Path("code_backups")
-        self.code_backups.mkdir(exist_ok=True)
+        self._backup_dir_ready = False  # папка создаётся при первом бэкапе, а не при импорте
+        self._file_cache: Optional[Tuple[float, List[os.DirEntry]]] = None
+        self._content_index: Optional[dict] = None  # sha256 -> путь уже сохранённой копии внутри code_backups
     
-    def analyze_own_code(self):
-        """Анализ собственного кода"""
-        issues = []
-        
-        # Проверить все .py файлы
-        py_files = list(Path(".").glob("*.py"))
-        
-        for file in py_files:
-            content = file.read_text(encoding="utf-8")
-            
-            # Искать анти-паттерны
-            if "не могу" in content.lower():
-                issues.append({
-                    "file": str(file),
-                    "issue": "Найдена фраза 'не могу'",
-                    "severity": "high"
-                })
-            
-            # Искать TODO
-            if "TODO" in content:
-                issues.append({
-                    "file": str(file),
-                    "issue": "Есть незавершенные TODO",
-                    "severity": "medium"
-                })
+    def _get_py_files(self, max_age: float = 1.0) -> List[os.DirEntry]:
+        """.py файлы текущей папки (scandir: без Path-объектов и fnmatch, is_file() без лишнего stat).
+        Список кэшируется на max_age секунд, чтобы анализ + бэкап подряд не сканировали папку дважды."""
+        now = time.monotonic()
+        if self._file_cache is not None and now - self._file_cache[0] < max_age:
+            return self._file_cache[1]
+        with os.scandir(".") as it:
+            files = [e for e in it if e.name.endswith(".py") and e.is_file()]
+        self._file_cache = (now, files)
+        return files
+    
+    def _backup_files(self, files: List[os.DirEntry], backup_dir: Path) -> None:
+        """Только бэкап: копирует ядро (sendfile), содержимое не проходит через Python;
+        копии идут параллельно — на I/O GIL отпускается"""
+        if not files:
+            return
+        self._load_content_index()
+        pairs = [(entry.path, backup_dir / entry.name) for entry in files]
+        with ThreadPoolExecutor(max_workers=min(8, len(pairs), (os.cpu_count() or 1) * 2)) as ex:
+            list(ex.map(lambda pair: self._backup_file(*pair), pairs))
+        self._save_content_index()
+    
+    def _scan_files(
+        self,
+        files: Optional[List[os.DirEntry]] = None,
+        backup_dir: Optional[Path] = None,
+    ) -> Iterator[dict]:
+        """Один проход по .py файлам: каждый файл читается один раз для анализа и бэкапа.
+        Проблемы отдаются по мере нахождения"""
+        if files is None:
+            files = self._get_py_files()
         
-        return issues
+        try:
+            for entry in files:
+                # хэш для бэкапа и поиск анти-паттернов идут по одному и тому же буферу
+                with _open_content(entry.path) as content:
+                    if backup_dir is not None:
+                        self._backup_file(entry.path, backup_dir / entry.name, content)
+                    
+                    # Большинство файлов отсекается поиском литерала (memchr), без запуска регулярки.
+                    # find(), а не `in`: mmap.__contains__ ищет только один байт
+                    if not any(content.find(literal) != -1 for literal in _PREFILTER_LITERALS):
+                        continue
+                    
+                    # Искать анти-паттерны
+                    found = set()
+                    for match in _ANTIPATTERN_RE.finditer(content):
+                        found.add(match.lastindex)
+                        if len(found) == len(_ANTIPATTERNS):
+                            break
+                
+                for kind, (issue, severity) in _ANTIPATTERNS.items():
+                    if kind in found:
+                        yield {
+                            "file": entry.name,
+                            "kind": kind,
+                            "issue": issue,
+                            "severity": severity
+                        }
+        finally:
+            # и при досрочном выходе вызывающего из цикла — уже сделанные копии попадают в индекс
+            if backup_dir is not None:
+                self._save_content_index()
+    
+    def analyze_own_code(self, files: Optional[List[os.DirEntry]] = None) -> Iterator[dict]:
+        """Анализ собственного кода (генератор: можно остановиться на первой проблеме)"""
+        return self._scan_files(files)
+    
+    def analyze_own_code_list(self, files: Optional[List[os.DirEntry]] = None) -> List[dict]:
+        """Все проблемы списком"""
+        return list(self.analyze_own_code(files))
     
     def propose_improvement(self, issue: dict) -> str:
         """Предложить улучшение"""
-        proposals = {
-            "Найдена фраза 'не могу'": "Заменить на конструктивное предложение решения",
-            "Есть незавершенные TODO": "Реализовать или убрать TODO"
-        }
+        return _PROPOSALS.get(issue.get("kind"), "Требуется анализ")
+    
+    def log_improvement(self, record: dict) -> None:
+        """Дописать запись в журнал улучшений (без перечитывания всего файла)"""
+        with self.improvements_log.open("ab") as f:
+            f.write(_dumps_line(record))
+    
+    def log_issues(self, issues: Iterable[dict]) -> None:
+        """Дописать пачку записей в журнал: один open и один writev вместо записи на каждую"""
+        lines = [_dumps_line(issue) for issue in issues]
+        if not lines:
+            return
+        if not hasattr(os, "writev"):  # Windows
+            with self.improvements_log.open("ab") as f:
+                f.writelines(lines)
+            return
+        fd = os.open(self.improvements_log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            for i in range(0, len(lines), _IOV_MAX):
+                batch = lines[i:i + _IOV_MAX]
+                written = os.writev(fd, batch)
+                rest = b"".join(batch)[written:]
+                while rest:  # частичная запись — дописываем остаток
+                    rest = rest[os.write(fd, rest):]
+        finally:
+            os.close(fd)
+    
+    def iter_improvements(self) -> Iterator[dict]:
+        """Записи журнала улучшений по одной"""
+        if not self.improvements_log.exists():
+            return
+        with self.improvements_log.open("rb") as f:
+            for line in f:
+                if line.strip():
+                    yield _loads(line)
+    
+    def _load_content_index(self) -> dict:
+        if self._content_index is None:
+            try:
+                index = _loads((self.code_backups / ".content_index.json").read_bytes())
+            except (OSError, ValueError):
+                index = {}
+            self._content_index = index if isinstance(index, dict) else {}  # битый файл (например null)
+        return self._content_index
+    
+    def _save_content_index(self) -> None:
+        if self._content_index is None:
+            return  # ни одного бэкапа — индекс не менялся
+        (self.code_backups / ".content_index.json").write_bytes(_dumps_line(self._content_index))
+    
+    def _backup_file(self, src: str, dst: Path, content: Optional[Union[bytes, mmap.mmap]] = None) -> None:
+        """Бэкап одного файла: если такое содержимое уже сохранялось — hardlink на старую копию вместо новой"""
+        index = self._load_content_index()
+        if content is not None:
+            digest = hashlib.sha256(content).hexdigest()
+        else:
+            with open(src, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+        
+        # dst может оказаться hardlink'ом из прошлых бэкапов — запись в него испортила бы их
+        try:
+            dst.unlink()
+        except FileNotFoundError:
+            pass
+        
+        existing = index.get(digest)
+        if existing is not None:
+            try:
+                os.link(self.code_backups / existing, dst)
+                return
+            except OSError:
+                pass  # старая копия удалена или ФС без hardlink'ов — обычное копирование
         
-        return proposals.get(issue["issue"], "Требуется анализ")
+        if content is not None:
+            dst.write_bytes(content)
+        else:
+            shutil.copyfile(src, dst)
+        index[digest] = dst.relative_to(self.code_backups).as_posix()
     
-    def backup_code(self):
-        """Создать бэкап перед изменениями"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    def _new_backup_dir(self) -> Path:
+        if not self._backup_dir_ready:
+            self.code_backups.mkdir(exist_ok=True)
+            self._backup_dir_ready = True
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
         backup_dir = self.code_backups / timestamp
         backup_dir.mkdir(exist_ok=True)
-        
-        for py_file in Path(".").glob("*.py"):
-            content = py_file.read_text(encoding="utf-8")
-            (backup_dir / py_file.name).write_text(content, encoding="utf-8")
-        
         return backup_dir
+    
+    def backup_code(self, files: Optional[List[os.DirEntry]] = None):
+        """Создать бэкап перед изменениями"""
+        backup_dir = self._new_backup_dir()
+        self._backup_files(files if files is not None else self._get_py_files(), backup_dir)
+        return backup_dir
+    
+    def analyze_and_backup(self, files: Optional[List[os.DirEntry]] = None):
+        """Анализ и бэкап за один проход (каждый файл читается один раз)"""
+        backup_dir = self._new_backup_dir()
+        issues = list(self._scan_files(files, backup_dir))
+        return issues, backup_dir
 
 
 self_improver = SelfImprover()
@@ -1,28 +1,61 @@
 # state.py — user memory, long-term storage, and behavior scenarios.
 # Responsibilities:
 #   - Keep per-user conversation history for model context.
-#   - Persist per-user memory (habits, goals, mistakes, mood/progress) to JSON.
+#   - Persist per-user memory (habits, goals, mistakes, mood/progress) to SQLite (state.db).
 #   - Maintain long-term signals (confirmed goals/habits, monthly themes, summaries).
 #   - Behavior scenarios with activation/deactivation and logging.
 #   - Lightweight tone/pattern detection for adaptive replies.
 
-import json
+import asyncio
+import atexit
+import heapq
 import os
 import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
 from collections import deque, Counter
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from itertools import islice
+from operator import itemgetter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from config import DEFAULT_MODEL, SYSTEM_PROMPT, GENERATION_CONFIG, AVRORA_PROFESSIONS, AVRORA_MAIN_GOAL
 
+try:
+    import orjson
+
+    def _json_dumps(data: Any) -> bytes:
+        return orjson.dumps(data, default=list, option=orjson.OPT_NON_STR_KEYS)  # default: deques
+
+    _json_loads = orjson.loads
+except ImportError:  # stdlib fallback, compact output
+    import json
+
+    def _json_dumps(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=list).encode("utf-8")
+
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
+STATE_DB = "state.db"  # SQLite (WAL): tables user_memory / long_term, one JSON blob per user
+MEMORY_TABLE = "user_memory"
+LONG_TERM_TABLE = "long_term"
+# older layout, migrated into state.db on first load
 MEMORY_FILE = "user_memory.json"
 LONG_TERM_FILE = "long_term.json"
+DIALOG_DIR = "dialog"  # per-user append-only dialog logs: dialog/<user_id>.jsonl
 MAX_HISTORY_LENGTH = 200  # cap messages to control RAM
 MAX_OBSERVATIONS = 200
 MAX_EVENTS = 50
 MAX_DIALOG_HISTORY = 200
+MAX_GOALS = 200  # cap for goals / habits / mistakes lists (oldest dropped)
+MAX_PATTERN_COUNTS = 500  # goal_counts / habit_counts size before one-off entries are dropped
+SAVE_MIN_INTERVAL = 2.0  # seconds between writes of the same store
+SAVE_MAX_PENDING = 20  # ...or flush once this many changes are unsaved
 RESTART_TIME = datetime.utcnow()
 
 # In-memory stores
@@ -37,41 +70,354 @@ def _now() -> str:
     return datetime.utcnow().isoformat()
 
 
-def _days_ago(days: int) -> datetime:
-    return datetime.utcnow() - timedelta(days=days)
+def _epoch_of(item: Dict[str, Any], iso_key: str, epoch_key: str) -> float:
+    """Numeric UTC timestamp stored next to an ISO one; older records are converted once and cached."""
+    value = item.get(epoch_key)
+    if value is None:
+        try:
+            value = datetime.fromisoformat(item[iso_key]).replace(tzinfo=timezone.utc).timestamp()
+        except Exception:
+            value = 0.0
+        item[epoch_key] = value
+    return value
+
+
+def _substring_matcher(tokens: Iterable[str]) -> Callable[[str], set]:
+    """Build f(text) -> set of tokens occurring in text, same result as `token in text` per token.
+
+    Lookahead alternation, longest tokens first, tried at every position in one regex pass.
+    At a position it reports only the longest token; any shorter token matching there is its
+    prefix, so the prefix closure restores overlapping hits.
+    """
+    tokens = [token for token in dict.fromkeys(tokens) if token]
+    if not tokens:
+        return lambda text: set()
+    pattern = re.compile("(?=(" + "|".join(map(re.escape, sorted(tokens, key=len, reverse=True))) + "))")
+    prefixes = {token: tuple(other for other in tokens if token.startswith(other)) for token in tokens}
+
+    def match(text: str) -> set:
+        found = set()
+        for longest in set(pattern.findall(text)):
+            found.update(prefixes[longest])
+        return found
+
+    return match
+
+
+# Membership sets mirroring append-only list fields (never persisted):
+# (store, user key, field) -> (list, its length when synced, set of its items)
+_member_sets: Dict[Tuple[str, str, str], Tuple[list, int, set]] = {}
+
+
+def _append_unique(slot: Tuple[str, str, str], items: list, value: Any) -> bool:
+    """Append value unless already in items; O(1) membership test. Returns True if appended."""
+    cached = _member_sets.get(slot)
+    if cached is None or cached[0] is not items or cached[1] != len(items):
+        members = set(items)  # first use, list replaced or changed elsewhere: resync
+    else:
+        members = cached[2]
+    added = value not in members
+    if added:
+        if getattr(items, "maxlen", None) is not None and len(items) == items.maxlen:
+            members.discard(items[0])  # full deque: append below evicts the oldest item
+        items.append(value)
+        members.add(value)
+    _member_sets[slot] = (items, len(items), members)
+    return added
+
+
+def _tail(items, n: int) -> list:
+    """Last n items of a list or deque (deques can't be sliced)."""
+    return list(islice(reversed(items), n))[::-1]
+
+
+# Capped history fields: kept as deque(maxlen=...) in memory, plain lists on disk
+_USER_BOUNDED = {
+    "observations": MAX_OBSERVATIONS,
+    "important_events": MAX_EVENTS,
+    "goals": MAX_GOALS,
+    "habits": MAX_GOALS,
+    "mistakes": MAX_GOALS,
+}
+_LONG_TERM_BOUNDED = {
+    "important_events": MAX_EVENTS,
+    "metacognition": 50,
+    "tuning_history": 50,
+    "personality_history": 100,
+    "emotion_history": 200,
+    "implicit_goals": 50,
+    "avoided_goals": 50,
+    "predicted_goals": 50,
+    "stalled_goals": 50,
+}
+
+
+def _ensure_bounded(data: Dict[str, Any], caps: Dict[str, int]) -> None:
+    for field, cap in caps.items():
+        value = data.get(field)
+        if not isinstance(value, deque) or value.maxlen != cap:
+            data[field] = deque(value or (), maxlen=cap)
 
 
 def _load_json(path: str) -> dict:
     if os.path.exists(path):
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
         except Exception:
             return {}
     return {}
 
 
-def _save_json(path: str, data: dict) -> None:
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
+# ---------------------- storage backend ---------------------- #
+_db: Optional[sqlite3.Connection] = None
+
+
+def _get_db() -> sqlite3.Connection:
+    """state.db in WAL mode: one row per user and store, a save rewrites only that row."""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(STATE_DB, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        for table in (MEMORY_TABLE, LONG_TERM_TABLE):
+            _db.execute(f"CREATE TABLE IF NOT EXISTS {table} (user_id TEXT PRIMARY KEY, blob BLOB NOT NULL)")
+    return _db
+
+
+def _load_table(table: str, legacy_file: str) -> Dict[str, Any]:
+    """All rows of a store; an empty table is filled from the older JSON file."""
+    data: Dict[str, Any] = {}
+    for key, blob in _get_db().execute(f"SELECT user_id, blob FROM {table}"):
+        try:
+            data[key] = _json_loads(blob)
+        except Exception:
+            logger.exception("Corrupted %s row for user %s", table, key)
+    if data:
+        return data
+    data = _load_json(legacy_file)
+    _dirty[table].update(data)  # written to the table right after load
+    return data
 
 
 # ---------------------- loaders ---------------------- #
 def load_memory() -> None:
     global user_memory, long_term
-    user_memory = _load_json(MEMORY_FILE)
-    long_term = _load_json(LONG_TERM_FILE)
+    user_memory = _load_table(MEMORY_TABLE, MEMORY_FILE)
+    long_term = _load_table(LONG_TERM_TABLE, LONG_TERM_FILE)
+    for table in (MEMORY_TABLE, LONG_TERM_TABLE):
+        if _dirty[table]:
+            _flush(table)
+
+
+def _store(table: str) -> Dict[str, Dict[str, Any]]:
+    return user_memory if table == MEMORY_TABLE else long_term
+
+
+# Debounced persistence: save_* only marks the user's row dirty; dirty rows are serialized at most
+# once per SAVE_MIN_INTERVAL, or once SAVE_MAX_PENDING changes piled up, plus on exit, and handed
+# to the saver thread, which writes them to state.db off the message-handling path. A deferred
+# save arms a trailing flush, so the last changes of a burst don't wait for the next message.
+_dirty: Dict[str, set] = {MEMORY_TABLE: set(), LONG_TERM_TABLE: set()}
+_dirty_lock = threading.Lock()  # the saver thread puts back keys whose write failed
+_pending_saves: Dict[str, int] = {MEMORY_TABLE: 0, LONG_TERM_TABLE: 0}
+_last_flush: Dict[str, float] = {MEMORY_TABLE: 0.0, LONG_TERM_TABLE: 0.0}
+_flush_timers: Dict[str, asyncio.TimerHandle] = {}
+# ("rows", table, [(user key, blob)]), ("dialog", user_id, [entry]) or ("dialog_reset", user_id, []);
+# the saver thread does all state.db writes and dialog log appends/resets/compactions (except
+# init_user's one-off legacy migration)
+_save_queue: "queue.Queue[Tuple[str, Any, list]]" = queue.Queue()
+_save_worker: Optional[threading.Thread] = None
+
+
+def _write_rows(table: str, rows: List[Tuple[str, bytes]]) -> None:
+    try:
+        db = _get_db()
+        with db:  # one transaction (and one WAL commit) per batch
+            db.executemany(f"INSERT OR REPLACE INTO {table} (user_id, blob) VALUES (?, ?)", rows)
+    except Exception:
+        logger.exception("Failed to save %s", table)
+        with _dirty_lock:
+            _dirty[table].update(key for key, _ in rows)  # retry on the next flush
+
+
+def _save_loop() -> None:
+    while True:
+        batches = [_save_queue.get()]
+        while True:  # take everything queued meanwhile; a newer row for the same user wins
+            try:
+                batches.append(_save_queue.get_nowait())
+            except queue.Empty:
+                break
+        merged: Dict[str, Dict[str, bytes]] = {}
+        dialogs: Dict[int, List[dict]] = {}
+        resets = set()
+        for kind, target, items in batches:
+            if kind == "dialog":
+                dialogs.setdefault(target, []).extend(items)  # keeps message order per user
+            elif kind == "dialog_reset":
+                dialogs[target] = []  # entries queued before the reset are dropped with the log
+                resets.add(target)
+            else:
+                merged.setdefault(target, {}).update(items)
+        try:
+            for table, rows in merged.items():
+                _write_rows(table, list(rows.items()))
+            for user_id in resets:
+                _clear_dialog(user_id)
+            for user_id, entries in dialogs.items():
+                if entries:
+                    _append_dialog(user_id, entries)  # one open/write per user per batch
+            if dialogs:
+                _compact_dialogs()
+        finally:
+            for _ in batches:
+                _save_queue.task_done()
+
+
+def _start_save_worker() -> None:
+    global _save_worker
+    if _save_worker is None:
+        _save_worker = threading.Thread(target=_save_loop, name="state-saver", daemon=True)
+        _save_worker.start()
+
+
+def _flush(table: str) -> None:
+    store = _store(table)
+    with _dirty_lock:
+        keys, _dirty[table] = _dirty[table], set()
+    # serialized here, on the thread that mutates the stores: the saver never sees a live dict
+    rows = [(key, _json_dumps(store[key])) for key in keys if key in store]
+    if rows:
+        _start_save_worker()
+        _save_queue.put(("rows", table, rows))
+    _pending_saves[table] = 0
+    _last_flush[table] = time.monotonic()
+
+
+def _request_save(table: str, user_id: Optional[int]) -> None:
+    with _dirty_lock:
+        if user_id is None:
+            _dirty[table].update(_store(table))  # caller didn't say whose data changed
+        else:
+            _dirty[table].add(str(user_id))
+    _pending_saves[table] += 1
+    if (
+        _pending_saves[table] >= SAVE_MAX_PENDING
+        or time.monotonic() - _last_flush[table] >= SAVE_MIN_INTERVAL
+    ):
+        _flush(table)
+    else:
+        _schedule_flush(table)
+
+
+def _schedule_flush(table: str) -> None:
+    """Arm a flush for when SAVE_MIN_INTERVAL is over; it runs on the event loop, the thread that
+    mutates the stores. Without a running loop (startup, scripts) the exit flush covers it."""
+    if table in _flush_timers:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    delay = max(0.0, SAVE_MIN_INTERVAL - (time.monotonic() - _last_flush[table]))
+    _flush_timers[table] = loop.call_later(delay, _deferred_flush, table)
+
+
+def _deferred_flush(table: str) -> None:
+    _flush_timers.pop(table, None)
+    if _dirty[table]:
+        _flush(table)
 
 
-def save_memory() -> None:
-    _save_json(MEMORY_FILE, user_memory)
+def save_memory(user_id: Optional[int] = None) -> None:
+    _request_save(MEMORY_TABLE, user_id)
 
 
-def save_long_term() -> None:
-    _save_json(LONG_TERM_FILE, long_term)
+def save_long_term(user_id: Optional[int] = None) -> None:
+    _request_save(LONG_TERM_TABLE, user_id)
+
+
+def force_flush() -> None:
+    """Write every store with unsaved changes now and wait for the saver thread (shutdown,
+    before reading the db externally)."""
+    for table, pending in _pending_saves.items():
+        if pending or _dirty[table]:
+            _flush(table)
+    if _save_worker is not None:
+        _save_queue.join()
+
+
+atexit.register(force_flush)
+
+
+# ---------------------- dialog log ---------------------- #
+_hydrated_users = set()  # users whose conversation_history was already restored from disk
+_dialog_line_counts: Dict[int, int] = {}  # lines currently in each dialog file
+
+
+def _dialog_path(user_id: int) -> str:
+    return os.path.join(DIALOG_DIR, f"{user_id}.jsonl")
+
+
+def _append_dialog(user_id: int, entries: List[dict]) -> None:
+    try:
+        os.makedirs(DIALOG_DIR, exist_ok=True)
+        with open(_dialog_path(user_id), "ab") as f:
+            f.write(b"".join(_json_dumps(entry) + b"\n" for entry in entries))
+        _dialog_line_counts[user_id] = _dialog_line_counts.get(user_id, 0) + len(entries)
+    except Exception:
+        logger.exception("Failed to append dialog log for user %s", user_id)
+
+
+def _clear_dialog(user_id: int) -> None:
+    try:
+        open(_dialog_path(user_id), "wb").close()
+        _dialog_line_counts[user_id] = 0
+    except FileNotFoundError:
+        pass  # nothing was logged yet
+    except Exception:
+        logger.exception("Failed to clear dialog log for user %s", user_id)
+
+
+def _load_dialog(user_id: int) -> List[dict]:
+    """Last MAX_DIALOG_HISTORY entries of the user's dialog log."""
+    tail = deque(maxlen=MAX_DIALOG_HISTORY)
+    count = 0
+    try:
+        with open(_dialog_path(user_id), "rb") as f:
+            for line in f:
+                if line.strip():
+                    tail.append(line)
+                    count += 1
+    except FileNotFoundError:
+        pass
+    _dialog_line_counts[user_id] = count
+    entries = []
+    for line in tail:
+        try:
+            entries.append(_json_loads(line))
+        except ValueError:
+            continue  # torn last line after a crash
+    return entries
+
+
+def _compact_dialogs() -> None:
+    """Trim dialog logs that grew past twice the kept window back to MAX_DIALOG_HISTORY lines."""
+    for user_id, count in list(_dialog_line_counts.items()):
+        if count <= 2 * MAX_DIALOG_HISTORY:
+            continue
+        path = _dialog_path(user_id)
+        try:
+            with open(path, "rb") as f:
+                tail = deque((line for line in f if line.strip()), maxlen=MAX_DIALOG_HISTORY)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.writelines(tail)
+            os.replace(tmp_path, path)
+            _dialog_line_counts[user_id] = len(tail)
+        except Exception:
+            logger.exception("Failed to compact dialog log for user %s", user_id)
 
 
 # ---------------------- init ---------------------- #
@@ -84,6 +430,9 @@ def _default_scenarios() -> Dict[str, Dict[str, Any]]:
     }
 
 
+_SCENARIO_NAMES = frozenset(_default_scenarios())
+
+
 def _default_long_term(user_id: int) -> Dict[str, Any]:
     return {
         "user_id": user_id,
@@ -119,18 +468,22 @@ def _default_long_term(user_id: int) -> Dict[str, Any]:
     }
 
 
+# Leading entry of every history; one shared dict, never mutated
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT["content"]}
+
+
 def init_user(user_id: int) -> None:
     """Ensure user structures exist."""
-    if user_id not in conversation_history:
-        conversation_history[user_id] = deque(maxlen=MAX_HISTORY_LENGTH)
-        conversation_history[user_id].append({"role": "system", "content": SYSTEM_PROMPT["content"]})
-
     key = str(user_id)
-    if key not in user_memory:
-        user_memory[key] = {
+    memory_changed = False
+    memory = user_memory.get(key)
+    if memory is None:
+        memory_changed = True
+        now = _now()
+        memory = user_memory[key] = {
             "user_id": user_id,
-            "created_at": _now(),
-            "updated_at": _now(),
+            "created_at": now,
+            "updated_at": now,
             "message_count": 0,
             "last_message": None,
             "last_reply": None,
@@ -145,44 +498,55 @@ def init_user(user_id: int) -> None:
             "observations": [],
             "important_events": [],
             "behavior_scenarios": _default_scenarios(),
-            "dialog_history": [],
             "pending_code_action": None,
         }
-    if key not in long_term:
-        long_term[key] = _default_long_term(user_id)
-    # Ensure dialog history structure exists
-    if "dialog_history" not in user_memory[key]:
-        user_memory[key]["dialog_history"] = []
-    if "pending_code_action" not in user_memory[key]:
-        user_memory[key]["pending_code_action"] = None
-    # Rehydrate conversation history from persisted dialog history
-    convo = deque(maxlen=MAX_HISTORY_LENGTH)
-    convo.append({"role": "system", "content": SYSTEM_PROMPT["content"]})
-    for item in user_memory[key].get("dialog_history", []):
-        convo.append(item)
-    conversation_history[user_id] = convo
-    save_memory()
-    save_long_term()
+    lt = long_term.get(key)
+    long_term_changed = lt is None
+    if long_term_changed:
+        lt = long_term[key] = _default_long_term(user_id)
+    _ensure_bounded(memory, _USER_BOUNDED)
+    _ensure_bounded(lt, _LONG_TERM_BOUNDED)
+    if "pending_code_action" not in memory:
+        memory["pending_code_action"] = None
+        memory_changed = True
+    # Migrate dialog history that used to live inside user_memory.json
+    if "dialog_history" in memory:
+        legacy_dialog = memory.pop("dialog_history")
+        if legacy_dialog and not os.path.exists(_dialog_path(user_id)):
+            _append_dialog(user_id, legacy_dialog)
+        memory_changed = True
+    # Create the conversation history, rehydrated from the persisted dialog log (once per process)
+    if user_id not in _hydrated_users:
+        convo = deque(maxlen=MAX_HISTORY_LENGTH)
+        convo.append(_SYSTEM_MESSAGE)
+        convo.extend(_load_dialog(user_id))
+        conversation_history[user_id] = convo
+        _hydrated_users.add(user_id)
+    # only new or migrated records need writing; most calls change nothing
+    if memory_changed:
+        save_memory(user_id)
+    if long_term_changed:
+        save_long_term(user_id)
 
 
 # ---------------------- conversation history ---------------------- #
 def reset_history(user_id: int) -> None:
     init_user(user_id)
     conversation_history[user_id].clear()
-    conversation_history[user_id].append({"role": "system", "content": SYSTEM_PROMPT["content"]})
+    conversation_history[user_id].append(_SYSTEM_MESSAGE)
+    # empty the persisted log too, or the cleared context would come back after a restart
+    _start_save_worker()
+    _save_queue.put(("dialog_reset", user_id, []))
 
 
 def append_message(user_id: int, role: str, content: str) -> None:
     init_user(user_id)
     conversation_history[user_id].append(
-        {"role": role, "content": content, "timestamp": _now()}
+        {"role": role, "content": content, "timestamp": time.time()}
     )
-    # persist to dialog_history for cross-restart memory
-    key = str(user_id)
-    dialog_hist = user_memory[key].get("dialog_history", [])
-    dialog_hist.append({"role": role, "content": content})
-    user_memory[key]["dialog_history"] = dialog_hist[-MAX_DIALOG_HISTORY:]
-    save_memory()
+    # persist to the dialog log for cross-restart memory (appended by the saver thread)
+    _start_save_worker()
+    _save_queue.put(("dialog", user_id, [{"role": role, "content": content}]))
 
 
 def get_history(user_id: int) -> List[dict]:
@@ -190,6 +554,12 @@ def get_history(user_id: int) -> List[dict]:
     return list(conversation_history[user_id])
 
 
+def get_history_tail(user_id: int, n: int) -> List[dict]:
+    """Last n history entries, without copying the rest."""
+    init_user(user_id)
+    return _tail(conversation_history[user_id], n)
+
+
 def set_model(model_name: str) -> None:
     current_model["name"] = model_name
 
@@ -212,56 +582,109 @@ KEYWORD_GROUPS = {
 POSITIVE_TOKENS = ["рад", "доволен", "счаст", "класс", "ура", "отлично", "кайф", "вдохнов"]
 NEGATIVE_TOKENS = ["плохо", "ужас", "груст", "злюсь", "злю", "бесит", "устал", "не хочу", "ненавиж", "страх"]
 
+IMPORTANT_TOKENS = ["важно", "срочно", "кризис", "критич", "help", "помоги"]
+# markers that turn a message into a goal / habit / mistake entry
+GOAL_MARKERS = ["хочу", "цель"]
+HABIT_MARKERS = ["привыч"]
+MISTAKE_MARKERS = ["ошиб", "факап"]
+
+_POS_TAG = "__pos__"
+_NEG_TAG = "__neg__"
+_IMPORTANT_TAG = "__important__"
+_GOAL_TAG = "__goal__"
+_HABIT_TAG = "__habit__"
+_MISTAKE_TAG = "__mistake__"
+
+
+def _build_token_tags() -> Dict[str, frozenset]:
+    """token -> tags it belongs to (keyword groups plus tone/importance/goal markers)."""
+    token_tags: Dict[str, set] = {}
+    groups = dict(KEYWORD_GROUPS)
+    groups.update({
+        _POS_TAG: POSITIVE_TOKENS,
+        _NEG_TAG: NEGATIVE_TOKENS,
+        _IMPORTANT_TAG: IMPORTANT_TOKENS,
+        _GOAL_TAG: GOAL_MARKERS,
+        _HABIT_TAG: HABIT_MARKERS,
+        _MISTAKE_TAG: MISTAKE_MARKERS,
+    })
+    for tag, tokens in groups.items():
+        for token in tokens:
+            token_tags.setdefault(token, set()).add(tag)
+    return {token: frozenset(tags) for token, tags in token_tags.items()}
 
-def detect_tone(text: str) -> float:
-    """Very simple sentiment: returns score between -1 and 1."""
-    t = text.lower()
-    pos = sum(token in t for token in POSITIVE_TOKENS)
-    neg = sum(token in t for token in NEGATIVE_TOKENS)
+
+_TOKEN_TAGS = _build_token_tags()
+
+_match_tokens = _substring_matcher(_TOKEN_TAGS)
+
+
+def _tone_from_tokens(tokens: set) -> float:
+    pos = sum(1 for token in tokens if _POS_TAG in _TOKEN_TAGS[token])
+    neg = sum(1 for token in tokens if _NEG_TAG in _TOKEN_TAGS[token])
     if pos == neg == 0:
         return 0.0
     return (pos - neg) / max(pos + neg, 1)
 
 
-def _update_patterns(profile: Dict[str, Any], text: str) -> Tuple[List[str], List[str], List[str]]:
+def detect_tone(text: str, tokens: Optional[set] = None) -> float:
+    """Very simple sentiment: returns score between -1 and 1."""
+    if tokens is None:
+        tokens = _match_tokens(text.lower())
+    return _tone_from_tokens(tokens)
+
+
+def _update_patterns(
+    profile: Dict[str, Any], text: str, tokens: Optional[set] = None, lower: Optional[str] = None
+) -> Tuple[List[str], List[str], List[str]]:
     """Keyword-based detector for goals, habits, mistakes."""
-    text_lower = text.lower()
+    text_lower = lower if lower is not None else text.lower()
+    if tokens is None:
+        tokens = _match_tokens(text_lower)
+    hit_tags = set()
+    for token in tokens:
+        hit_tags |= _TOKEN_TAGS[token]
+    key = str(profile["user_id"])
     triggered = []
-    for tag, tokens in KEYWORD_GROUPS.items():
-        if any(token in text_lower for token in tokens):
-            if tag not in profile["patterns"]:
-                profile["patterns"].append(tag)
+    for tag in KEYWORD_GROUPS:
+        if tag in hit_tags:
+            _append_unique(("user", key, "patterns"), profile["patterns"], tag)
             triggered.append(tag)
 
     new_goals = []
     new_habits = []
     new_mistakes = []
-    if "хочу" in text_lower or "цель" in text_lower:
+    if _GOAL_TAG in hit_tags:
         new_goals.append(text.strip()[:120])
-    if "привыч" in text_lower:
+    if _HABIT_TAG in hit_tags:
         new_habits.append(text.strip()[:120])
-    if "ошиб" in text_lower or "факап" in text_lower:
+    if _MISTAKE_TAG in hit_tags:
         new_mistakes.append(text.strip()[:120])
 
     for g in new_goals:
-        if g not in profile["goals"]:
-            profile["goals"].append(g)
+        _append_unique(("user", key, "goals"), profile["goals"], g)
     for h in new_habits:
-        if h not in profile["habits"]:
-            profile["habits"].append(h)
+        _append_unique(("user", key, "habits"), profile["habits"], h)
     for m in new_mistakes:
-        if m not in profile["mistakes"]:
-            profile["mistakes"].append(m)
+        _append_unique(("user", key, "mistakes"), profile["mistakes"], m)
 
     return new_goals, new_habits, new_mistakes
 
 
-def _mark_important(profile: Dict[str, Any], text: str, tags: List[str]) -> None:
+def _mark_important(
+    profile: Dict[str, Any], text: str, tags: List[str], lower: Optional[str] = None,
+    now: Optional[str] = None, tokens: Optional[set] = None,
+) -> None:
     """Mark important messages (emotionally charged or tagged)."""
-    important_tokens = ["важно", "срочно", "кризис", "критич", "help", "помоги"]
-    if any(tok in text.lower() for tok in important_tokens) or tags:
-        profile["important_events"].append({"ts": _now(), "message": text[:200], "tags": tags})
-        profile["important_events"] = profile["important_events"][-MAX_EVENTS:]
+    if tokens is None:
+        tokens = _match_tokens(lower if lower is not None else text.lower())
+    if tags or any(_IMPORTANT_TAG in _TOKEN_TAGS[token] for token in tokens):
+        profile["important_events"].append({"ts": now or _now(), "message": text[:200], "tags": tags})
+
+
+# tags that push progress_score up / down
+_PROGRESS_TAGS = frozenset({"growth", "health", "finance", "motivation"})
+_SETBACK_TAGS = frozenset({"stress", "fatigue"})
 
 
 def _update_scores(profile: Dict[str, Any], tone_score: float, triggered: List[str]) -> None:
@@ -269,8 +692,14 @@ def _update_scores(profile: Dict[str, Any], tone_score: float, triggered: List[s
     prev_mood = profile["mood_score"]
     prev_prog = profile["progress_score"]
     profile["mood_score"] = round((profile["mood_score"] * 0.8) + (tone_score * 0.2), 3)
-    delta = 0.05 * sum(1 for t in triggered if t in {"growth", "health", "finance", "motivation"})
-    delta -= 0.05 * sum(1 for t in triggered if t in {"stress", "fatigue"})
+    pos = neg = 0
+    for t in triggered:  # one pass for both counts
+        if t in _PROGRESS_TAGS:
+            pos += 1
+        elif t in _SETBACK_TAGS:
+            neg += 1
+    delta = 0.05 * pos
+    delta -= 0.05 * neg
     profile["progress_score"] = round(max(-1.0, min(1.5, profile["progress_score"] + delta)), 3)
     if profile["mood_score"] != prev_mood or profile["progress_score"] != prev_prog:
         logger.info("Scores updated user=%s mood=%s->%s progress=%s->%s", profile["user_id"], prev_mood, profile["mood_score"], prev_prog, profile["progress_score"])
@@ -278,28 +707,32 @@ def _update_scores(profile: Dict[str, Any], tone_score: float, triggered: List[s
 
 # -------- long-term tracking ---------------------------------------------- #
 def _bump_counter(counter: Dict[str, int], key: str) -> int:
-    counter[key] = counter.get(key, 0) + 1
-    return counter[key]
+    count = counter[key] = counter.get(key, 0) + 1
+    if len(counter) > MAX_PATTERN_COUNTS:
+        # drop phrases seen only once (never close to confirmation) to keep the dict bounded
+        for stale in [k for k, v in counter.items() if v == 1 and k != key]:
+            del counter[stale]
+    return count
 
 
 def detect_confirmed_goals(user_id: int, goals: List[str]) -> None:
-    lt = long_term[str(user_id)]
+    key = str(user_id)
+    lt = long_term[key]
     for g in goals:
         count = _bump_counter(lt["goal_counts"], g)
-        if count >= 3 and g not in lt["confirmed_goals"]:
-            lt["confirmed_goals"].append(g)
+        if count >= 3 and _append_unique(("lt", key, "confirmed_goals"), lt["confirmed_goals"], g):
             logger.info("Confirmed goal for user %s: %s", user_id, g)
-    save_long_term()
+    save_long_term(user_id)
 
 
 def detect_habits(user_id: int, habits: List[str]) -> None:
-    lt = long_term[str(user_id)]
+    key = str(user_id)
+    lt = long_term[key]
     for h in habits:
         count = _bump_counter(lt["habit_counts"], h)
-        if count >= 5 and h not in lt["confirmed_habits"]:
-            lt["confirmed_habits"].append(h)
+        if count >= 5 and _append_unique(("lt", key, "confirmed_habits"), lt["confirmed_habits"], h):
             logger.info("Confirmed habit for user %s: %s", user_id, h)
-    save_long_term()
+    save_long_term(user_id)
 
 
 def _ensure_plan(user_id: int) -> Dict[str, Any]:
@@ -310,6 +743,7 @@ def _ensure_plan(user_id: int) -> Dict[str, Any]:
         return lt["plans"][-1]
     plan = {
         "date": _now(),
+        "date_epoch": time.time(),
         "short": [],
         "mid": [],
         "long": [],
@@ -325,11 +759,7 @@ def _needs_new_plan(user_id: int) -> bool:
     lt = long_term[str(user_id)]
     if not lt.get("plans"):
         return True
-    try:
-        last_date = datetime.fromisoformat(lt["plans"][-1]["date"])
-        return last_date < _days_ago(1)
-    except Exception:
-        return True
+    return _epoch_of(lt["plans"][-1], "date", "date_epoch") < time.time() - 86400
 
 
 def generate_plan(user_id: int, profile: Dict[str, Any]) -> Dict[str, Any]:
@@ -342,6 +772,7 @@ def generate_plan(user_id: int, profile: Dict[str, Any]) -> Dict[str, Any]:
     goal_text = goals[0] if goals else "улучшить общее состояние"
     plan = {
         "date": _now(),
+        "date_epoch": time.time(),
         "short": [f"Сделать 1 шаг к цели: {goal_text}", "10 минут чтения/обучения", "2 минуты планирования"],
         "mid": [f"Сформировать чек-лист на неделю по цели: {goal_text}", "Проверить прогресс через 3 дня"],
         "long": [f"Оценить результаты через месяц по цели: {goal_text}"],
@@ -351,7 +782,7 @@ def generate_plan(user_id: int, profile: Dict[str, Any]) -> Dict[str, Any]:
     }
     lt["plans"].append(plan)
     logger.info("Plan generated for user %s", user_id)
-    save_long_term()
+    save_long_term(user_id)
     return plan
 
 
@@ -366,26 +797,26 @@ def mark_done(user_id: int, text: str) -> str:
     """Mark a plan item done by substring or index."""
     plan = get_plan(user_id)
     lists = [("short", "completed_short"), ("mid", "completed_mid"), ("long", "completed_long")]
+    # parse and lowercase the query once, not per plan bucket / per item
+    try:
+        idx: Optional[int] = int(text) - 1
+    except ValueError:
+        idx = None
+    text_lc = text.lower()
     for src, dest in lists:
         items = plan.get(src, [])
         # numeric index support
-        try:
-            idx = int(text) - 1
-            if 0 <= idx < len(items):
-                item = items.pop(idx)
-                plan[dest].append(item)
-                save_long_term()
-                return f"Отмечено выполненным: {item}"
-        except ValueError:
-            pass
-        # substring match
-        for item in list(items):
-            if text.lower() in item.lower():
-                items.remove(item)
-                plan[dest].append(item)
-                save_long_term()
-                return f"Отмечено выполненным: {item}"
-    save_long_term()
+        if idx is not None and 0 <= idx < len(items):
+            pos = idx
+        else:
+            # substring match
+            pos = next((i for i, item in enumerate(items) if text_lc in item.lower()), None)
+        if pos is not None:
+            item = items.pop(pos)
+            plan[dest].append(item)
+            save_long_term(user_id)
+            return f"Отмечено выполненным: {item}"
+    save_long_term(user_id)  # get_plan may have just created an empty plan
     return "Не нашёл такой пункт в плане."
 
 
@@ -397,53 +828,68 @@ def update_themes(user_id: int, tags: List[str]) -> None:
 
 def make_monthly_summary(user_id: int) -> None:
     lt = long_term[str(user_id)]
-    last = lt.get("last_summary_at")
-    if last:
-        try:
-            last_dt = datetime.fromisoformat(last)
-            if last_dt > _days_ago(7):
-                return
-        except Exception:
-            pass
+    now_epoch = time.time()
+    if lt.get("last_summary_at") and _epoch_of(lt, "last_summary_at", "last_summary_epoch") > now_epoch - 7 * 86400:
+        return
+    now_iso = _now()
     themes = sorted(lt["monthly_theme_counts"].items(), key=lambda x: x[1], reverse=True)
     top_themes = ", ".join(f"{t}×{c}" for t, c in themes[:5]) or "нет данных"
     summary = {
-        "created_at": _now(),
+        "created_at": now_iso,
         "top_themes": top_themes,
         "goals": lt["confirmed_goals"][-5:],
         "habits": lt["confirmed_habits"][-5:],
         "weekly_finance_score": lt.get("weekly_finance_score", 0.0),
     }
     lt["monthly_summaries"].append(summary)
-    lt["last_summary_at"] = _now()
+    lt["last_summary_at"] = now_iso
+    lt["last_summary_epoch"] = now_epoch
     logger.info("Monthly summary generated for user %s", user_id)
-    save_long_term()
+    save_long_term(user_id)
 
 
 # -------- behavior scenarios ---------------------------------------------- #
+_checked_scenarios: Dict[int, Dict[str, Dict[str, Any]]] = {}  # user_id -> scenarios dict already merged with defaults
+
+
 def _get_scenarios(user_id: int) -> Dict[str, Dict[str, Any]]:
+    key = str(user_id)
+    data = user_memory.get(key)
+    if data is not None:
+        scenarios = data.get("behavior_scenarios")
+        # same dict as last time -> defaults already merged (soft_reboot/reload put a new dict here)
+        if scenarios is not None and _checked_scenarios.get(user_id) is scenarios:
+            return scenarios
     init_user(user_id)
-    data = user_memory[str(user_id)]
+    data = user_memory[key]
     # ensure scenarios exist and include all default keys
+    changed = False
     if "behavior_scenarios" not in data:
         data["behavior_scenarios"] = _default_scenarios()
-        save_memory()
-    defaults = _default_scenarios()
-    for k, v in defaults.items():
-        if k not in data["behavior_scenarios"]:
-            data["behavior_scenarios"][k] = v.copy()
-    return data["behavior_scenarios"]
+        changed = True
+    scenarios = data["behavior_scenarios"]
+    if not _SCENARIO_NAMES <= scenarios.keys():  # build the defaults only if some are missing
+        for k, v in _default_scenarios().items():
+            if k not in scenarios:
+                scenarios[k] = v
+        changed = True
+    if changed:
+        save_memory(user_id)
+    _checked_scenarios[user_id] = scenarios
+    return scenarios
 
 
 def _activate(user_id: int, name: str) -> None:
     scenarios = _get_scenarios(user_id)
+    now = _now()
     scenarios[name]["state"] = "ACTIVE"
-    scenarios[name]["last_activation"] = _now()
-    user_memory[str(user_id)]["important_events"].append({"ts": _now(), "event": f"{name}_activated"})
-    long_term[str(user_id)]["important_events"].append({"ts": _now(), "event": f"{name}_activated"})
+    scenarios[name]["last_activation"] = now
+    key = str(user_id)
+    user_memory[key]["important_events"].append({"ts": now, "event": f"{name}_activated"})
+    long_term[key]["important_events"].append({"ts": now, "event": f"{name}_activated"})
     logger.info("Scenario activated: %s for user %s", name, user_id)
-    save_memory()
-    save_long_term()
+    save_memory(user_id)
+    save_long_term(user_id)
 
 
 def _deactivate(user_id: int, name: str) -> None:
@@ -451,16 +897,17 @@ def _deactivate(user_id: int, name: str) -> None:
     if scenarios[name]["state"] == "ACTIVE":
         scenarios[name]["state"] = "INACTIVE"
         logger.info("Scenario deactivated: %s for user %s", name, user_id)
-        save_memory()
+        save_memory(user_id)
 
 
 def evaluate_scenarios(user_id: int) -> None:
     """Check conditions and activate/deactivate scenarios."""
     init_user(user_id)
-    profile = user_memory[str(user_id)]
+    key = str(user_id)
+    profile = user_memory[key]
     scenarios = _get_scenarios(user_id)
     obs = profile.get("observations", [])
-    last3 = obs[-3:]
+    last3 = _tail(obs, 3)
     last3_tones = [o.get("tone", 0) for o in last3]
 
     # LowMoodSupport
@@ -472,8 +919,13 @@ def evaluate_scenarios(user_id: int) -> None:
         _deactivate(user_id, "LowMoodSupport")
 
     # ProductivityPush
-    recent = [o for o in obs if datetime.fromisoformat(o["ts"]) > _days_ago(7)]
-    goal_mentions = sum(1 for o in recent for tag in o.get("tags", []) if tag in {"growth"})
+    cutoff = time.time() - 7 * 86400
+    # one pass over last week's tags instead of one per scenario
+    tag_counts = Counter()
+    for o in obs:
+        if _epoch_of(o, "ts", "ts_epoch") > cutoff:
+            tag_counts.update(o.get("tags", ()))
+    goal_mentions = tag_counts["growth"]
     if goal_mentions >= 2 and profile["progress_score"] < 0.3:
         if scenarios["ProductivityPush"]["state"] != "ACTIVE":
             _activate(user_id, "ProductivityPush")
@@ -482,18 +934,18 @@ def evaluate_scenarios(user_id: int) -> None:
         _deactivate(user_id, "ProductivityPush")
 
     # FinancialFocus
-    finance_mentions = sum(1 for o in recent for tag in o.get("tags", []) if tag == "finance")
+    finance_mentions = tag_counts["finance"]
     if finance_mentions >= 3:
         if scenarios["FinancialFocus"]["state"] != "ACTIVE":
             _activate(user_id, "FinancialFocus")
-        lt = long_term[str(user_id)]
+        lt = long_term[key]
         lt["weekly_finance_score"] = min(10.0, lt.get("weekly_finance_score", 0.0) + 0.5)
-        save_long_term()
+        save_long_term(user_id)
     else:
         _deactivate(user_id, "FinancialFocus")
 
     # SocialBonding
-    social_mentions = sum(1 for o in recent for tag in o.get("tags", []) if tag == "relationships")
+    social_mentions = tag_counts["relationships"]
     if social_mentions >= 2 and profile["mood_score"] > -0.3:
         _activate(user_id, "SocialBonding")
     else:
@@ -510,38 +962,75 @@ def get_scenarios_report(user_id: int) -> str:
 
 
 # -------- observations pipeline ------------------------------------------- #
+RECENT_TAG_WINDOW = 10  # observations counted by update_personality
+
+# user_id -> (observations deque, newest observation counted, tag -> observations in the window
+# carrying it); kept in step by _push_observation, rebuilt if the deque was replaced or changed elsewhere
+_recent_tag_counts: Dict[int, Tuple[deque, Optional[dict], Counter]] = {}
+
+
+def _recent_tags(user_id: int, observations: deque) -> Counter:
+    """Per-tag count of the last RECENT_TAG_WINDOW observations containing it."""
+    newest = observations[-1] if observations else None
+    cached = _recent_tag_counts.get(user_id)
+    if cached is not None and cached[0] is observations and cached[1] is newest:
+        return cached[2]
+    counts = Counter()
+    for o in _tail(observations, RECENT_TAG_WINDOW):
+        counts.update(set(o.get("tags", ())))
+    _recent_tag_counts[user_id] = (observations, newest, counts)
+    return counts
+
+
+def _push_observation(user_id: int, observations: deque, observation: dict) -> None:
+    """Append an observation and slide the recent-tag window: O(tags) instead of a rescan."""
+    counts = _recent_tags(user_id, observations)
+    if len(observations) >= RECENT_TAG_WINDOW:
+        counts.subtract(set(observations[-RECENT_TAG_WINDOW].get("tags", ())))  # leaves the window
+    observations.append(observation)
+    counts.update(set(observation.get("tags", ())))
+    _recent_tag_counts[user_id] = (observations, observation, counts)
+
+
 def add_observation(user_id: int, message_text: str) -> None:
     """Update user memory with new message context and derived insights."""
     init_user(user_id)
     profile = user_memory[str(user_id)]
     profile["message_count"] += 1
     profile["last_message"] = message_text
-    profile["updated_at"] = _now()
+    now_iso = _now()  # one timestamp for everything this message touches
+    now_epoch = time.time()
+    profile["updated_at"] = now_iso
 
-    tone_score = detect_tone(message_text)
-    new_goals, new_habits, new_mistakes = _update_patterns(profile, message_text)
+    # lowercase once; one scan over the text feeds tone, keyword groups, goal markers and importance
     lower_text = message_text.lower()
-    custom_hits = [flt for flt in profile.get("custom_filters", []) if flt and flt in lower_text]
+    tokens = _match_tokens(lower_text)
+    tone_score = detect_tone(message_text, tokens)
+    new_goals, new_habits, new_mistakes = _update_patterns(profile, message_text, tokens, lower_text)
+    filters = profile.get("custom_filters", [])
+    filter_hits = _custom_filter_matcher(user_id, filters)(lower_text) if filters else ()
+    custom_hits = [flt for flt in filters if flt in filter_hits]
     triggered = [p for p in profile["patterns"] if p in lower_text] + custom_hits
     _update_scores(profile, tone_score, triggered)
-    _mark_important(profile, message_text, triggered)
+    _mark_important(profile, message_text, triggered, lower_text, now_iso, tokens)
 
-    profile["observations"].append(
-        {"ts": _now(), "message": message_text, "tone": tone_score, "tags": triggered}
+    _push_observation(
+        user_id,
+        profile["observations"],
+        {"ts": now_iso, "ts_epoch": now_epoch, "message": message_text, "tone": tone_score, "tags": triggered},
     )
-    profile["observations"] = profile["observations"][-MAX_OBSERVATIONS:]
 
     # long-term updates
     detect_confirmed_goals(user_id, new_goals)
     detect_habits(user_id, new_habits)
     update_themes(user_id, triggered)
     make_monthly_summary(user_id)
-    update_emotion_matrix(user_id, message_text)
+    update_emotion_matrix(user_id, message_text, lower_text, now_iso)
     update_personality(user_id)
     update_goal_reasoner(user_id)
     update_life_strategy(user_id)
 
-    save_memory()
+    save_memory(user_id)
 
 
 def record_reply(user_id: int, reply_text: str) -> None:
@@ -549,14 +1038,15 @@ def record_reply(user_id: int, reply_text: str) -> None:
     profile = user_memory[str(user_id)]
     profile["last_reply"] = reply_text
     profile["updated_at"] = _now()
-    save_memory()
+    save_memory(user_id)
 
 
 # -------- summaries & getters --------------------------------------------- #
 def get_profile_summary(user_id: int) -> str:
     init_user(user_id)
-    p = user_memory[str(user_id)]
-    lt = long_term[str(user_id)]
+    key = str(user_id)
+    p = user_memory[key]
+    lt = long_term[key]
     lines = [
         f"Создано: {p['created_at']}",
         f"Сообщений: {p['message_count']}",
@@ -575,9 +1065,10 @@ def get_profile_summary(user_id: int) -> str:
 
 def get_progress_report(user_id: int) -> str:
     init_user(user_id)
-    p = user_memory[str(user_id)]
-    lt = long_term[str(user_id)]
-    recent = p.get("observations", [])[-10:]
+    key = str(user_id)
+    p = user_memory[key]
+    lt = long_term[key]
+    recent = _tail(p.get("observations", []), 10)
     tags = Counter(tag for obs in recent for tag in obs.get("tags", []))
     top_tags = ", ".join(f"{k}×{v}" for k, v in tags.most_common()) or "нет данных"
     return (
@@ -621,11 +1112,25 @@ def get_habits(user_id: int) -> List[str]:
 def add_custom_filter(user_id: int, pattern: str) -> None:
     """Custom user-defined keyword to track."""
     init_user(user_id)
-    p = user_memory[str(user_id)]
-    if pattern and pattern not in p["custom_filters"]:
-        p["custom_filters"].append(pattern)
+    key = str(user_id)
+    p = user_memory[key]
+    if pattern:
+        _append_unique(("user", key, "custom_filters"), p["custom_filters"], pattern)
     p["updated_at"] = _now()
-    save_memory()
+    save_memory(user_id)
+
+
+# user_id -> (filters snapshot, compiled matcher); rebuilt when the filter list changes
+_custom_filter_cache: Dict[int, Tuple[tuple, Callable[[str], set]]] = {}
+
+
+def _custom_filter_matcher(user_id: int, filters: List[str]) -> Callable[[str], set]:
+    signature = tuple(filters)
+    cached = _custom_filter_cache.get(user_id)
+    if cached is None or cached[0] != signature:
+        cached = (signature, _substring_matcher(signature))
+        _custom_filter_cache[user_id] = cached
+    return cached[1]
 
 
 def get_custom_filters(user_id: int) -> List[str]:
@@ -646,7 +1151,7 @@ def get_active_scenarios(user_id: int) -> List[str]:
 def set_last_seen(user_id: int) -> None:
     init_user(user_id)
     long_term[str(user_id)]["last_seen_at"] = _now()
-    save_long_term()
+    save_long_term(user_id)
 
 
 def get_last_seen(user_id: int):
@@ -663,7 +1168,7 @@ def get_last_seen(user_id: int):
 def set_last_greet(user_id: int) -> None:
     init_user(user_id)
     long_term[str(user_id)]["last_greet_at"] = _now()
-    save_long_term()
+    save_long_term(user_id)
 
 
 def get_last_greet(user_id: int):
@@ -680,7 +1185,7 @@ def get_last_greet(user_id: int):
 def set_pending_action(user_id: int, action: dict) -> None:
     init_user(user_id)
     user_memory[str(user_id)]["pending_code_action"] = action
-    save_memory()
+    save_memory(user_id)
 
 
 def get_pending_action(user_id: int) -> dict:
@@ -691,15 +1196,16 @@ def get_pending_action(user_id: int) -> dict:
 def clear_pending_action(user_id: int) -> None:
     init_user(user_id)
     user_memory[str(user_id)]["pending_code_action"] = None
-    save_memory()
+    save_memory(user_id)
 
 
 # -------- metacognition --------------------------------------------------- #
 def evaluate_metacognition(user_id: int, last_user: str, last_reply: str) -> Dict[str, float]:
     """Simple self-eval: length balance, scenario alignment, mood impact."""
     init_user(user_id)
-    profile = user_memory[str(user_id)]
-    lt = long_term[str(user_id)]
+    key = str(user_id)
+    profile = user_memory[key]
+    lt = long_term[key]
     user_len = len(last_user or "")
     reply_len = len(last_reply or "")
     length_score = 0.5 if user_len == 0 else min(1.0, (reply_len / user_len))
@@ -718,10 +1224,9 @@ def evaluate_metacognition(user_id: int, last_user: str, last_reply: str) -> Dic
         "empathy_score": round(empathy_score, 3),
         "motivation_score": round(motivation_score, 3),
     }
-    lt.setdefault("metacognition", []).append(entry)
-    lt["metacognition"] = lt["metacognition"][-50:]
+    lt["metacognition"].append(entry)
     logger.info("Metacog user=%s quality=%.2f empathy=%.2f motivation=%.2f", user_id, reply_quality, empathy_score, motivation_score)
-    save_long_term()
+    save_long_term(user_id)
     return entry
 
 
@@ -741,18 +1246,39 @@ def adjust_from_metacognition(user_id: int) -> Dict[str, Any]:
     tuning.update({"temperature": rec_temp, "topP": rec_top_p, "last_adjusted": _now()})
     lt["tuning_state"] = tuning
     logger.info("Metacog adjust user=%s temp=%.2f topP=%.2f", user_id, rec_temp, rec_top_p)
-    save_long_term()
+    save_long_term(user_id)
     return tuning
 
 
+# Inputs each idempotent updater last ran with: (updater, user_id) -> (long_term record, signature).
+# Same record and same signature means a re-run would write identical results, so it is skipped.
+_updater_signatures: Dict[Tuple[str, int], Tuple[Dict[str, Any], tuple]] = {}
+
+
+def _inputs_unchanged(updater: str, user_id: int, lt: Dict[str, Any], signature: tuple) -> bool:
+    """True if updater's last recomputation used exactly these inputs."""
+    last = _updater_signatures.get((updater, user_id))
+    return last is not None and last[0] is lt and last[1] == signature
+
+
+def _remember_inputs(updater: str, user_id: int, lt: Dict[str, Any], signature: tuple) -> None:
+    """Record the inputs of a finished recomputation; early returns must not call this."""
+    _updater_signatures[(updater, user_id)] = (lt, signature)
+
+
 # -------- forecasting ----------------------------------------------------- #
 def forecast_user(user_id: int) -> Dict[str, Any]:
     """Heuristic forecasts for mood, crisis, goals, themes."""
     init_user(user_id)
-    profile = user_memory[str(user_id)]
-    lt = long_term[str(user_id)]
+    key = str(user_id)
+    profile = user_memory[key]
+    lt = long_term[key]
     mood = profile.get("mood_score", 0)
     progress = profile.get("progress_score", 0)
+    # the forecast is a pure function of these three; "ts" stays the time it was computed
+    signature = (tuple(profile.get("patterns", [])), mood, progress)
+    if _inputs_unchanged("forecast", user_id, lt, signature):
+        return lt["forecast"]
     mood_forecast = [round(max(-1.0, min(1.0, mood - 0.05 * i)), 2) for i in range(1, 4)]
     crisis_risk = {
         "low_mood": 0.7 if mood < -0.2 else 0.3,
@@ -773,7 +1299,8 @@ def forecast_user(user_id: int) -> Dict[str, Any]:
         "ts": _now(),
     }
     lt["forecast"] = forecast
-    save_long_term()
+    _remember_inputs("forecast", user_id, lt, signature)
+    save_long_term(user_id)
     return forecast
 
 
@@ -781,10 +1308,11 @@ def forecast_user(user_id: int) -> Dict[str, Any]:
 def self_tuning(user_id: int) -> Dict[str, Any]:
     """Analyze history to adjust generation recommendations."""
     init_user(user_id)
-    lt = long_term[str(user_id)]
-    profile = user_memory[str(user_id)]
+    key = str(user_id)
+    lt = long_term[key]
+    profile = user_memory[key]
     tuning = lt.get("tuning_state", {}).copy()
-    observations = profile.get("observations", [])[-20:]
+    observations = _tail(profile.get("observations", []), 20)
     ignored = sum(1 for o in observations if "!" not in o.get("message", ""))
     # simple heuristic: if many ignored messages, reduce length/temperature
     if ignored > 10:
@@ -793,11 +1321,10 @@ def self_tuning(user_id: int) -> Dict[str, Any]:
     else:
         tuning["temperature"] = tuning.get("temperature", GENERATION_CONFIG.get("temperature", 0.9))
     tuning["updated_at"] = _now()
-    lt.setdefault("tuning_history", []).append(tuning.copy())
-    lt["tuning_history"] = lt["tuning_history"][-50:]
+    lt["tuning_history"].append(tuning.copy())
     lt["tuning_state"] = tuning
     logger.info("Self-tuning user=%s tuning=%s", user_id, tuning)
-    save_long_term()
+    save_long_term(user_id)
     return tuning
 
 
@@ -811,75 +1338,87 @@ EMOTION_KEYWORDS = {
     "fear": ["страх", "боюсь", "тревог", "паник"],
 }
 
+_EMOTION_OF_TOKEN: Dict[str, frozenset] = {}
+for _emo, _keys in EMOTION_KEYWORDS.items():
+    for _key in _keys:
+        _EMOTION_OF_TOKEN[_key] = _EMOTION_OF_TOKEN.get(_key, frozenset()) | {_emo}
+_match_emotion_tokens = _substring_matcher(_EMOTION_OF_TOKEN)  # one pass for all emotion keywords
+
 
-def update_emotion_matrix(user_id: int, text: str) -> Dict[str, float]:
+def update_emotion_matrix(
+    user_id: int, text: str, lower: Optional[str] = None, now: Optional[str] = None
+) -> Dict[str, float]:
     init_user(user_id)
     lt = long_term[str(user_id)]
     matrix = lt.get("emotion_matrix", {}).copy()
-    t = text.lower()
-    for emo, keys in EMOTION_KEYWORDS.items():
-        if any(k in t for k in keys):
+    t = lower if lower is not None else text.lower()
+    hit = set()
+    for token in _match_emotion_tokens(t):
+        hit |= _EMOTION_OF_TOKEN[token]
+    for emo in EMOTION_KEYWORDS:
+        if emo in hit:
             matrix[emo] = round(min(1.0, matrix.get(emo, 0.0) + 0.1), 3)
         else:
             matrix[emo] = round(max(0.0, matrix.get(emo, 0.0) * 0.98), 3)
     lt["emotion_matrix"] = matrix
-    lt.setdefault("emotion_history", []).append({"ts": _now(), "matrix": matrix})
-    lt["emotion_history"] = lt["emotion_history"][-200:]
-    save_long_term()
+    lt["emotion_history"].append({"ts": now or _now(), "matrix": matrix})
+    save_long_term(user_id)
     return matrix
 
 
 # -------- personality modeling ------------------------------------------- #
+PERSONALITY_TRAITS = (
+    "discipline", "emotional_stability", "decisiveness",
+    "creativity", "social_energy", "financial_maturity",
+)
+
+
 def update_personality(user_id: int) -> Dict[str, float]:
     init_user(user_id)
-    lt = long_term[str(user_id)]
-    profile = user_memory[str(user_id)]
-    scores = lt.get("personality_scores", {
-        "discipline": 0.5, "emotional_stability": 0.5, "decisiveness": 0.5,
-        "creativity": 0.5, "social_energy": 0.5, "financial_maturity": 0.5
-    })
+    key = str(user_id)
+    lt = long_term[key]
+    profile = user_memory[key]
+    prev = lt.get("personality_scores") or {}  # new users start from 0.5 for every trait
     mood = profile.get("mood_score", 0)
     prog = profile.get("progress_score", 0)
     patterns = profile.get("patterns", [])
-    obs = profile.get("observations", [])[-10:]
-    mentions_goals = sum("growth" in o.get("tags", []) for o in obs)
-    mentions_fin = sum("finance" in o.get("tags", []) for o in obs)
-    discipline = min(1.0, max(0.0, scores["discipline"] + 0.05 * mentions_goals))
-    emotional_stability = min(1.0, max(0.0, 0.6 + mood * 0.4))
-    decisiveness = min(1.0, max(0.0, scores["decisiveness"] + (0.05 if prog > 0.3 else -0.02)))
-    creativity = min(1.0, max(0.0, scores["creativity"] + (0.03 if "motivation" in patterns else 0)))
-    social_energy = min(1.0, max(0.0, scores["social_energy"] + (0.02 if "relationships" in patterns else -0.01)))
-    financial_maturity = min(1.0, max(0.0, scores["financial_maturity"] + 0.05 * mentions_fin))
-    scores.update({
-        "discipline": round(discipline, 3),
-        "emotional_stability": round(emotional_stability, 3),
-        "decisiveness": round(decisiveness, 3),
-        "creativity": round(creativity, 3),
-        "social_energy": round(social_energy, 3),
-        "financial_maturity": round(financial_maturity, 3),
-    })
+    recent_tags = _recent_tags(user_id, profile["observations"])
+    mentions_goals = recent_tags["growth"]
+    mentions_fin = recent_tags["finance"]
+    raw = (
+        prev.get("discipline", 0.5) + 0.05 * mentions_goals,
+        0.6 + mood * 0.4,
+        prev.get("decisiveness", 0.5) + (0.05 if prog > 0.3 else -0.02),
+        prev.get("creativity", 0.5) + (0.03 if "motivation" in patterns else 0),
+        prev.get("social_energy", 0.5) + (0.02 if "relationships" in patterns else -0.01),
+        prev.get("financial_maturity", 0.5) + 0.05 * mentions_fin,
+    )
+    # clamp to [0, 1] and round in one pass; a new dict per call so history entries stay snapshots
+    scores = dict(prev)
+    for trait, value in zip(PERSONALITY_TRAITS, raw):
+        scores[trait] = round(min(1.0, max(0.0, value)), 3)
     lt["personality_scores"] = scores
-    lt.setdefault("personality_history", []).append({"ts": _now(), "scores": scores})
-    lt["personality_history"] = lt["personality_history"][-100:]
-    save_long_term()
+    lt["personality_history"].append({"ts": _now(), "scores": scores})
+    save_long_term(user_id)
     return scores
 
 
 # -------- life strategy --------------------------------------------------- #
 def update_life_strategy(user_id: int) -> None:
     init_user(user_id)
-    lt = long_term[str(user_id)]
-    profile = user_memory[str(user_id)]
+    key = str(user_id)
+    lt = long_term[key]
+    profile = user_memory[key]
     patterns = profile.get("patterns", [])
     mood = profile.get("mood_score", 0)
     progress = profile.get("progress_score", 0)
-    last = lt.get("last_strategy_at")
-    if last:
-        try:
-            if datetime.fromisoformat(last) > _days_ago(5) and progress > 0.4:
-                return
-        except Exception:
-            pass
+    if (progress > 0.4 and lt.get("last_strategy_at")
+            and _epoch_of(lt, "last_strategy_at", "last_strategy_epoch") > time.time() - 5 * 86400):
+        return
+    # the strategy is a pure function of these three
+    signature = (tuple(patterns), mood, progress)
+    if _inputs_unchanged("life_strategy", user_id, lt, signature):
+        return
     strengths = []
     weaknesses = []
     directions = ["финансы", "карьера", "психология", "дисциплина", "отношения", "стиль жизни"]
@@ -915,20 +1454,38 @@ def update_life_strategy(user_id: int) -> None:
     lt["strategic_risks"] = risks
     lt["mindset_profile"] = mindset
     lt["last_strategy_at"] = _now()
-    save_long_term()
+    lt["last_strategy_epoch"] = time.time()
+    _remember_inputs("life_strategy", user_id, lt, signature)
+    save_long_term(user_id)
 
 
 # -------- goal reasoner --------------------------------------------------- #
 def update_goal_reasoner(user_id: int) -> None:
     init_user(user_id)
-    lt = long_term[str(user_id)]
-    profile = user_memory[str(user_id)]
+    key = str(user_id)
+    lt = long_term[key]
+    profile = user_memory[key]
     patterns = profile.get("patterns", [])
-    goals = profile.get("goals", []) + lt.get("confirmed_goals", [])
-    implicit = lt.get("implicit_goals", [])
-    avoided = lt.get("avoided_goals", [])
-    predicted = lt.get("predicted_goals", [])
-    stalled = lt.get("stalled_goals", [])
+    profile_goals = profile.get("goals", [])
+    confirmed_goals = lt.get("confirmed_goals", [])
+    goals = [*profile_goals, *confirmed_goals]
+    # "avoided" grows on every low-mood call, so only the other branches can be skipped
+    signature = None
+    if not (profile.get("mood_score", 0) < -0.3 and goals):
+        signature = (
+            "growth" in patterns,
+            "finance" in patterns,
+            profile.get("progress_score", 0) < 0.2,
+            len(profile_goals), profile_goals[-1] if profile_goals else None,
+            len(confirmed_goals), confirmed_goals[-1] if confirmed_goals else None,
+        )
+        if _inputs_unchanged("goal_reasoner", user_id, lt, signature):
+            return
+    # capped deques (see _LONG_TERM_BOUNDED): appends past 50 drop the oldest, no re-slicing
+    implicit = lt["implicit_goals"]
+    avoided = lt["avoided_goals"]
+    predicted = lt["predicted_goals"]
+    stalled = lt["stalled_goals"]
 
     if "growth" in patterns and goals:
         for g in goals:
@@ -944,11 +1501,9 @@ def update_goal_reasoner(user_id: int) -> None:
     if profile.get("mood_score", 0) < -0.3 and goals:
         avoided.append("эмоциональные запросы")
 
-    lt["implicit_goals"] = implicit[-50:]
-    lt["avoided_goals"] = avoided[-50:]
-    lt["predicted_goals"] = predicted[-50:]
-    lt["stalled_goals"] = stalled[-50:]
-    save_long_term()
+    if signature is not None:
+        _remember_inputs("goal_reasoner", user_id, lt, signature)
+    save_long_term(user_id)
 
 
 # -------- auto-step runner ----------------------------------------------- #
@@ -980,12 +1535,12 @@ def build_super_context(user_id: int) -> str:
     mindset = lt.get("mindset_profile", {})
     personality = lt.get("personality_scores", {})
     emotions = lt.get("emotion_matrix", {})
-    top_emotions = sorted(emotions.items(), key=lambda x: x[1], reverse=True)[:3] if emotions else []
+    top_emotions = heapq.nlargest(3, emotions.items(), key=itemgetter(1))
     goal_reason = {
-        "implicit": lt.get("implicit_goals", []),
-        "avoided": lt.get("avoided_goals", []),
-        "predicted": lt.get("predicted_goals", []),
-        "stalled": lt.get("stalled_goals", []),
+        "implicit": list(lt.get("implicit_goals", ())),
+        "avoided": list(lt.get("avoided_goals", ())),
+        "predicted": list(lt.get("predicted_goals", ())),
+        "stalled": list(lt.get("stalled_goals", ())),
     }
     summary = [
         f"Главная цель: {AVRORA_MAIN_GOAL}",
@@ -1011,13 +1566,12 @@ def build_super_context(user_id: int) -> str:
 # -------- soft reboot ----------------------------------------------------- #
 def soft_reboot(user_id: int) -> None:
     """Reset transient states but keep long-term memory."""
-    init_user(user_id)
-    conversation_history[user_id].clear()
-    conversation_history[user_id].append({"role": "system", "content": SYSTEM_PROMPT["content"]})
-    user_memory[str(user_id)]["behavior_scenarios"] = _default_scenarios()
-    user_memory[str(user_id)]["observations"] = []
-    user_memory[str(user_id)]["important_events"] = []
-    save_memory()
+    reset_history(user_id)
+    key = str(user_id)
+    user_memory[key]["behavior_scenarios"] = _default_scenarios()
+    user_memory[key]["observations"] = deque(maxlen=MAX_OBSERVATIONS)
+    user_memory[key]["important_events"] = deque(maxlen=MAX_EVENTS)
+    save_memory(user_id)
 
 
 # Initialize memory on import
@@ -1,12 +1,14 @@
 # voice_utils.py — Улучшенная версия 2025 года
 # Теперь Веран говорит ГРЯЗНО, с армянским акцентом, шепчет, стонет, орёт и унижает голосом
 
+import hashlib
 import os
 import tempfile
 import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from gtts import gTTS
 from pydub import AudioSegment
-from pydub.effects import normalize, speedup, compress_dynamic_range
 import speech_recognition as sr
 
 # ──────── СЛОВА-ДОБАВКИ ДЛЯ АРМЯНСКОГО АКЦЕНТА И ДОМИНАЦИИ ────────
@@ -21,30 +23,143 @@ DIRTY_PHRASES = [
     "Լիզիր էկրանը, kyanq...", "Իմ ձայնով ես կոնչում, չէ՞...", "Լաց եղիր ինձ համար...",
     "Դու իմն ես, shun...", "Հայկական ձայնով tunem qez..."
 ]
+_ALL_PHRASES = (*ARMENIAN_TRASH, *DIRTY_PHRASES)  # собирается один раз, а не на каждый вызов
+
+# ──────── КЭШ gTTS: одинаковый текст не ходит в сеть повторно ────────
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MAX_FILES = 500  # сверх лимита удаляются давно не использованные mp3
+
+
+def _prune_tts_cache() -> None:
+    with os.scandir(TTS_CACHE_DIR) as it:
+        entries = [e for e in it if e.name.endswith(".mp3")]
+    if len(entries) <= TTS_CACHE_MAX_FILES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - TTS_CACHE_MAX_FILES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _tts_mp3(text: str, lang: str = "ru") -> str:
+    """Путь к mp3 с озвучкой text: из кэша, а при промахе — через gTTS"""
+    key = hashlib.sha1(f"{text}|{lang}".encode("utf-8")).hexdigest()
+    mp3_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    if os.path.exists(mp3_path):
+        os.utime(mp3_path)  # mtime = последнее использование (LRU)
+        return mp3_path
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{mp3_path}.{os.getpid()}.tmp"
+    gTTS(text=text, lang=lang, slow=False).save(tmp_path)
+    os.replace(tmp_path, mp3_path)  # недописанный файл никогда не попадёт в кэш
+    _prune_tts_cache()
+    return mp3_path
+
+
+# ──────── DSP НА NUMPY: один проход по PCM вместо цепочки pydub-эффектов ────────
+def _db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+def _to_samples(audio: AudioSegment) -> np.ndarray:
+    """Моно 16-бит PCM → float32 в диапазоне [-1, 1]"""
+    audio = audio.set_channels(1).set_sample_width(2)
+    return np.frombuffer(audio.raw_data, dtype=np.int16).astype(np.float32) / 32768
+
+
+def _from_samples(samples: np.ndarray, frame_rate: int) -> AudioSegment:
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    return AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+
+
+def _rc_filter(samples: np.ndarray, frame_rate: int, low_cut: float | None = None,
+               high_cut: float | None = None) -> np.ndarray:
+    """RC-фильтры (как low/high_pass_filter в pydub), но одним умножением в частотной области.
+    Хвост из нулей — чтобы «эхо» БПФ не заворачивалось в начало"""
+    n = len(samples)
+    padded = n + frame_rate // 20
+    freqs = np.fft.rfftfreq(padded, 1 / frame_rate)
+    response = np.ones_like(freqs, dtype=np.complex64)
+    if high_cut:
+        response /= 1 + 1j * freqs / high_cut  # low-pass
+    if low_cut:
+        response *= (1j * freqs / low_cut) / (1 + 1j * freqs / low_cut)  # high-pass
+    return np.fft.irfft(np.fft.rfft(samples, padded) * response, padded)[:n].astype(np.float32)
+
+
+def _echo(samples: np.ndarray, frame_rate: int, delay: float = 0.1, decay: float = 0.4) -> np.ndarray:
+    """Линия задержки: исходник + его затухающая копия через delay секунд"""
+    d = int(frame_rate * delay)
+    out = np.concatenate([samples, np.zeros(d, dtype=np.float32)])
+    out[d:] += decay * samples
+    return out
+
+
+def _compress(samples: np.ndarray, frame_rate: int, threshold: float = -20.0, ratio: float = 4.0,
+              window_ms: int = 10) -> np.ndarray:
+    """Компрессор: уровень по RMS окон, всё выше порога ослабляется в ratio раз"""
+    win = max(1, frame_rate * window_ms // 1000)
+    frames = len(samples) // win
+    if frames == 0:
+        return samples
+    rms = np.sqrt(np.mean(samples[:frames * win].reshape(frames, win) ** 2, axis=1))
+    level = 20 * np.log10(np.maximum(rms, 1e-9))
+    reduction = np.maximum(level - threshold, 0) * (1 - 1 / ratio)
+    # усиление плавно интерполируется между центрами окон — без щелчков на стыках
+    centers = np.arange(frames) * win + win / 2
+    gain = np.interp(np.arange(len(samples)), centers, _db_to_gain(-reduction))
+    return (samples * gain).astype(np.float32)
+
+
+def _stretch(samples: np.ndarray, speed: float) -> np.ndarray:
+    """Ускорение/замедление передискретизацией (как плёнка: тон меняется вместе с темпом)"""
+    if speed == 1.0 or len(samples) < 2:
+        return samples
+    positions = np.arange(0, len(samples) - 1, speed)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def _normalize(samples: np.ndarray, headroom: float = 0.1) -> np.ndarray:
+    """Пик на -headroom дБ (как pydub.effects.normalize)"""
+    peak = float(np.max(np.abs(samples))) if len(samples) else 0.0
+    if peak == 0.0:
+        return samples
+    return samples * (_db_to_gain(-headroom) / peak)
+
 
 # ──────── РАСПОЗНАВАНИЕ ГОЛОСА (улучшено + поддержка армянского) ────────
+# Порядок = приоритет: русский, потом армянский, потом английский
+_RECOGNITION_LANGS = ("ru-RU", "hy-AM", "en-US")
+
+# Запросы к Google по всем языкам идут параллельно; общий пул, чтобы не ждать
+# завершения ненужных запросов при выходе из with
+_recognition_pool = ThreadPoolExecutor(max_workers=len(_RECOGNITION_LANGS), thread_name_prefix="speech")
+
+
 def voice_to_text(voice_file_path: str) -> str | None:
     try:
-        # Конвертим ogg → wav
-        audio = AudioSegment.from_ogg(voice_file_path)
-        wav_path = voice_file_path.replace(".ogg", ".wav")
-        audio.export(wav_path, format="wav")
+        # ogg → моно PCM 16 кГц прямо в память: без промежуточного wav на диске
+        audio = AudioSegment.from_ogg(voice_file_path).set_channels(1).set_frame_rate(16000)
+        audio_data = sr.AudioData(audio.raw_data, audio.frame_rate, audio.sample_width)
 
         recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_path) as source:
-            audio_data = recognizer.record(source)
 
-        # Пробуем русский, потом армянский, потом английский
-        for lang in ["ru-RU", "hy-AM", "en-US"]:
+        # Все языки запускаются сразу, результаты берутся по приоритету:
+        # в худшем случае ждём самый медленный запрос, а не сумму всех трёх
+        futures = [(lang, _recognition_pool.submit(recognizer.recognize_google, audio_data, language=lang))
+                   for lang in _RECOGNITION_LANGS]
+        for lang, future in futures:
             try:
-                text = recognizer.recognize_google(audio_data, language=lang)
-                os.remove(wav_path)
-                print(f"[VOICE → TEXT] Распознано ({lang}): {text}")
-                return text.lower()
+                text = future.result()
             except sr.UnknownValueError:
                 continue
+            for _, rest in futures:
+                rest.cancel()  # ещё не начатые (пул занят другими голосовыми) уже не нужны
+            print(f"[VOICE → TEXT] Распознано ({lang}): {text}")
+            return text.lower()
 
-        os.remove(wav_path)
         return None
 
     except Exception as e:
@@ -52,8 +167,25 @@ def voice_to_text(voice_file_path: str) -> str | None:
         return None
 
 
+# libopus для речи: voip-режим, 24 кбит/с и минимальная сложность кодера (по умолчанию 96k, complexity 10)
+_OPUS_PARAMS = ["-b:a", "24k", "-application", "voip", "-compression_level", "0", "-threads", "1"]
+
+
 # ──────── СИНТЕЗ ГОЛОСА — ВЕРАН ГОВОРИТ КАК НАСТОЯЩАЯ ДОМИНА ────────
-def text_to_voice(text: str, domination_mode: bool = True) -> str | None:
+def _random_speed() -> float:
+    """Случайно: ускоряем или замедляем (иногда шепчет медленно, иногда орёт)"""
+    if random.random() < 0.3:
+        return 1.15  # агрессивно
+    if random.random() < 0.3:
+        return 0.85  # медленно, угрожающе
+    return 1.0
+
+
+def _render_voice(text: str, domination_mode: bool = True, speed_factor: float = 1.0,
+                  post_gain_db: float = 0.0, post_echo: bool = False,
+                  post_high_cut: float | None = None) -> str | None:
+    """gTTS + все эффекты за один проход по PCM; post_* — добавки поверх нормализованного голоса
+    (для наказания/шёпота), без повторного декодирования готового ogg"""
     try:
         # Ограничиваем длину (Telegram лимит ~60 сек)
         if len(text) > 480:
@@ -61,44 +193,45 @@ def text_to_voice(text: str, domination_mode: bool = True) -> str | None:
 
         # Добавляем грязь и армянский акцент, если включён режим доминации
         if domination_mode and random.random() < 0.7:
-            trash = random.choice(ARMENIAN_TRASH + DIRTY_PHRASES)
+            trash = random.choice(_ALL_PHRASES)
             text = f"{text}... {trash}"
 
-        # Временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
-            mp3_path = fp.name
-
-        # Генерируем голос (русский, но с "армянским" налётом)
-        tts = gTTS(text=text, lang="ru", slow=False)
-        tts.save(mp3_path)
+        # Генерируем голос (русский, но с "армянским" налётом); повторный текст берётся из кэша
+        mp3_path = _tts_mp3(text, lang="ru")
 
         # ──────── ЭФФЕКТЫ ГОЛОСА ВЕРАНА (2025 BDSM edition) ────────
+        # mp3 декодируется один раз, все эффекты идут по одному массиву PCM
         audio = AudioSegment.from_mp3(mp3_path)
+        rate = audio.frame_rate
+        samples = _to_samples(audio)
 
         # 1. Глубокий, сексуальный голос (понижаем тон)
-        audio = audio.low_pass_filter(3000).high_pass_filter(80) - 4  # -4 дБ тише
+        samples = _rc_filter(samples, rate, low_cut=80, high_cut=3000) * _db_to_gain(-4)  # -4 дБ тише
 
         # 2. Добавляем эхо и "присутствие" (как будто в комнате)
-        audio = audio.echo()
+        samples = _echo(samples, rate)
 
         # 3. Лёгкая компрессия (чтобы шёпот был громким)
-        audio = compress_dynamic_range(audio, threshold=-20.0, ratio=4.0)
+        samples = _compress(samples, rate, threshold=-20.0, ratio=4.0)
 
-        # 4. Случайно: ускоряем или замедляем (иногда шепчет медленно, иногда орёт)
-        if random.random() < 0.3:
-            audio = audio.speedup(playback_speed=1.15)  # агрессивно
-        elif random.random() < 0.3:
-            audio = audio.speedup(playback_speed=0.85)  # медленно, угрожающе
+        # 4. Темп: случайный, умноженный на заданный — одна передискретизация вместо двух
+        samples = _stretch(samples, _random_speed() * speed_factor)
 
         # 5. Нормализация громкости
-        audio = normalize(audio)
+        samples = _normalize(samples)
 
-        # Сохраняем финальный ogg (Telegram любит ogg/opus)
-        ogg_path = mp3_path.replace(".mp3", ".ogg")
-        audio.export(ogg_path, format="ogg", codec="libopus")
+        # 6. Добавки для особых режимов
+        if post_gain_db:
+            samples = samples * _db_to_gain(post_gain_db)
+        if post_echo:
+            samples = _echo(samples, rate)
+        if post_high_cut:
+            samples = _rc_filter(samples, rate, high_cut=post_high_cut)
 
-        # Удаляем mp3
-        os.remove(mp3_path)
+        # Сохраняем финальный ogg (Telegram любит ogg/opus); mp3 остаётся в кэше
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as fp:
+            ogg_path = fp.name
+        _from_samples(samples, rate).export(ogg_path, format="ogg", codec="libopus", parameters=_OPUS_PARAMS)
 
         print(f"[TEXT → VOICE] Веран сказала: {text[:60]}...")
         return ogg_path
@@ -108,38 +241,20 @@ def text_to_voice(text: str, domination_mode: bool = True) -> str | None:
         return None
 
 
+def text_to_voice(text: str, domination_mode: bool = True) -> str | None:
+    return _render_voice(text, domination_mode)
+
+
 # ──────── БОНУС: ГОЛОС ДЛЯ ОСОБЫХ МОМЕНТОВ (оргазм, наказание) ────────
 def text_to_voice_punishment(text: str) -> str | None:
     """Когда Веран наказывает — голос становится громким, с эхом и вибрато"""
-    voice_file = text_to_voice(text, domination_mode=True)
-    if not voice_file:
-        return None
-
-    try:
-        audio = AudioSegment.from_ogg(voice_file)
-        # Максимально агрессивно
-        audio = audio + 8  # громче
-        audio = audio.echo()
-        audio = audio.speedup(playback_speed=1.2)
-        audio = audio.low_pass_filter(2500)
-        audio.export(voice_file, format="ogg", codec="libopus")
-        return voice_file
-    except:
-        return voice_file
+    # Максимально агрессивно: громче, ещё эхо, быстрее, глуше
+    return _render_voice(text, domination_mode=True, speed_factor=1.2,
+                         post_gain_db=8, post_echo=True, post_high_cut=2500)
 
 
 def text_to_voice_whisper(text: str) -> str | None:
     """Шёпот — когда приказывает кончить без рук"""
-    voice_file = text_to_voice(text, domination_mode=True)
-    if not voice_file:
-        return None
-
-    try:
-        audio = AudioSegment.from_ogg(voice_file)
-        audio = audio - 12  # тихо
-        audio = audio.low_pass_filter(2000)
-        audio = audio.echo()
-        audio.export(voice_file, format="ogg", codec="libopus")
-        return voice_file
-    except:
-        return voice_file
\ No newline at end of file
+    # тихо, глухо, с эхом
+    return _render_voice(text, domination_mode=True,
+                         post_gain_db=-12, post_echo=True, post_high_cut=2000)